@@ -0,0 +1,86 @@
+"""Append-only, compressed archive of submitted interviews.
+
+Usage: python archive.py [--chat 123456] [--date 2026-01-31]
+
+Each day's interviews go to ARCHIVE_DIR/interviews-<date>.jsonl.gz, one
+gzip member per interview, so a file is only ever appended to and still
+reads as a single stream with zcat. index.tsv beside them records the
+chat id, date, file, offset and length of every interview, so one can be
+read back without decompressing the whole day. The files live on the
+worker that ran archive_session.
+
+`rescore.py --archive` appends a re-scored interview again, marked
+"rescored", so the latest record of a chat supersedes the earlier ones.
+"""
+import argparse
+import datetime
+import fcntl
+import gzip
+import json
+import os
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+INDEX_FILE = "index.tsv"
+
+
+def append_record(chat_id, record):
+    """Append one interview to today's file and the index."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    date = now.strftime("%Y-%m-%d")
+    name = f"interviews-{date}.jsonl.gz"
+    data = gzip.compress(
+        (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+    )
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, INDEX_FILE), "a", encoding="utf-8") as index:
+        # The index lock also serializes writers to the data files, across
+        # threads and processes
+        fcntl.flock(index, fcntl.LOCK_EX)
+        try:
+            with open(os.path.join(ARCHIVE_DIR, name), "ab") as archive:
+                offset = archive.seek(0, os.SEEK_END)
+                archive.write(data)
+                archive.flush()
+                os.fsync(archive.fileno())
+
+            index.write(
+                f"{chat_id}\t{date}\t{now.isoformat()}\t{name}\t{offset}\t{len(data)}\n"
+            )
+            index.flush()
+        finally:
+            fcntl.flock(index, fcntl.LOCK_UN)
+
+
+def find_records(chat_id=None, date=None):
+    """Yield the archived interviews for a chat and/or a date, oldest first."""
+    path = os.path.join(ARCHIVE_DIR, INDEX_FILE)
+    if not os.path.exists(path):
+        return
+
+    with open(path, encoding="utf-8") as index:
+        entries = [line.rstrip("\n").split("\t") for line in index if line.strip()]
+
+    for entry_chat, entry_date, _, name, offset, length in entries:
+        if chat_id is not None and entry_chat != str(chat_id):
+            continue
+        if date is not None and entry_date != date:
+            continue
+
+        with open(os.path.join(ARCHIVE_DIR, name), "rb") as archive:
+            archive.seek(int(offset))
+            yield json.loads(gzip.decompress(archive.read(int(length))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chat", help="only this chat id")
+    parser.add_argument("--date", help="only this day, as YYYY-MM-DD (UTC)")
+    args = parser.parse_args()
+
+    for record in find_records(args.chat, args.date):
+        print(json.dumps(record, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+"""Async web entry point: the same handlers, run on an event loop.
+
+An alternative to main.py for holding many conversations in one process.
+The webhook is served by aiohttp and the handlers from handlers.py run
+with AsyncIO, which talks to Redis, the Bot API and OpenAI without
+blocking the loop. Queueing Celery tasks and the once-per-candidate
+submit path (batched scoring, assembling the report) have no async
+counterpart and run in the loop's default thread pool.
+
+Set WEB_RUNTIME=async to have the Procfile's web process serve it:
+
+    gunicorn async_main:app --worker-class aiohttp.GunicornWebWorker
+"""
+import asyncio
+import contextlib
+import os
+import time
+import uuid
+
+from aiohttp import web
+from redis.asyncio import BlockingConnectionPool, Redis
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot, ExceptionHandler
+
+import common
+from common import (
+    BOT_TOKEN,
+    ChatBusy,
+    CHAT_BUSY_NOTICE,
+    CHAT_LOCK_RENEW,
+    CHAT_LOCK_TIMEOUT,
+    OPENAI_API_KEY,
+    OPENAI_CONNECT_TIMEOUT,
+    OPENAI_KEEPALIVE_EXPIRY,
+    OPENAI_MAX_ATTEMPTS,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE,
+    OPENAI_QUEUE_TIMEOUT,
+    OPENAI_TIMEOUT,
+    SCORE_CACHE_MAX_ENTRIES,
+    SCORE_CACHE_TTL,
+    SESSION_TTL,
+    TELEGRAM_API_URL,
+    TELEGRAM_MAX_ATTEMPTS,
+    TELEGRAM_MAX_CONNECTIONS,
+    TELEGRAM_SEND_MODE,
+    UPDATE_DEDUP_TTL,
+    answer_args,
+    cache_counter_key,
+    cache_evicted_keys,
+    chat_lock_args,
+    failure_labels,
+    get_local_score,
+    logger,
+    metric_labels,
+    openai_lease_key,
+    openai_limit_args,
+    openai_retry,
+    openai_slot_args,
+    openai_slot_delay,
+    openai_was_fast,
+    outgoing_message,
+    parse_score,
+    prompts,
+    queue_cache_touch,
+    queue_cache_write,
+    queue_observation,
+    queue_outbox_message,
+    redis_url,
+    render_metrics,
+    report_key,
+    score_cache_key,
+    score_request,
+    set_local_score,
+    telegram_retry_after,
+    telegram_send_args,
+    telegram_slot_args,
+    update_key,
+)
+from handlers import register_handlers
+from tasks import deliver_messages, process_update
+
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# "inline" runs the handlers on the loop, "queue" hands updates to Celery
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "inline")
+# Requests beyond this wait for a free connection instead of opening more
+ASYNC_REDIS_MAX_CONNECTIONS = int(os.environ.get("ASYNC_REDIS_MAX_CONNECTIONS", 200))
+
+if "TELEGRAM_API_URL" in os.environ:
+    asyncio_helper.API_URL = f"{TELEGRAM_API_URL}/bot{{0}}/{{1}}"
+    asyncio_helper.FILE_URL = f"{TELEGRAM_API_URL}/file/bot{{0}}/{{1}}"
+asyncio_helper.REQUEST_LIMIT = TELEGRAM_MAX_CONNECTIONS
+
+
+class AsyncIO:
+    """The I/O the shared handlers use on the event loop.
+
+    Mirrors common.SyncIO. The keys, script arguments and retry decisions
+    come from the same helpers in common as the blocking versions, so this
+    process, the Flask web processes and the workers all share the
+    sessions, limiters, caches and metrics; only the awaits differ.
+    """
+
+    def __init__(self, redis_client, bot, openai_client):
+        self.redis = redis_client
+        self.bot = bot
+        self.openai = openai_client
+        self.scripts = {
+            name: redis_client.register_script(getattr(common, f"{name}_script").script)
+            for name in (
+                "save_answer",
+                "rewind",
+                "acquire_openai",
+                "adjust_openai",
+                "acquire_telegram",
+            )
+        }
+
+    async def observe(self, name, seconds, **labels):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            queue_observation(pipe, name, seconds, labels)
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error recording {name}: {e}")
+
+    async def increment(self, name, amount=1, **labels):
+        try:
+            await self.redis.hincrby(f"metrics:{name}", metric_labels(labels), amount)
+        except Exception as e:
+            logger.error(f"Error recording {name}: {e}")
+
+    @contextlib.asynccontextmanager
+    async def timed(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            await self.increment("stage_failures_total", **failure_labels(stage, e))
+            raise
+        finally:
+            await self.observe(
+                "stage_duration_seconds", time.monotonic() - started, stage=stage
+            )
+
+    async def claim_update(self, update_id):
+        try:
+            return bool(
+                await self.redis.set(
+                    update_key(update_id), 1, nx=True, ex=UPDATE_DEDUP_TTL
+                )
+            )
+        except Exception as e:
+            logger.error(f"Error claiming update {update_id}: {e}")
+            return True
+
+    async def release_update(self, update_id):
+        try:
+            await self.redis.delete(update_key(update_id))
+        except Exception as e:
+            logger.error(f"Error releasing update {update_id}: {e}")
+
+    async def get_current_question(self, chat_id):
+        async with self.timed("redis_session"):
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hget(chat_id, "cursor")
+            pipe.hlen(chat_id)
+            cursor, answers = await pipe.execute()
+        return int(cursor) if cursor is not None else answers
+
+    async def save_answer(self, chat_id, question_number, answer):
+        try:
+            async with self.timed("redis_session"):
+                next_question = await self.scripts["save_answer"](
+                    keys=[chat_id, report_key(chat_id)],
+                    args=answer_args(question_number, answer) + [SESSION_TTL],
+                )
+            if next_question < 0:
+                print(f"Discarded stale answer to question {question_number} for {chat_id}")
+                return None
+
+            await self.increment("answers_saved_total", question=question_number)
+            return next_question
+
+        except Exception as e:
+            print(f"Error in save_answer {e}")
+            return None
+
+    async def rewind_question(self, chat_id):
+        async with self.timed("redis_session"):
+            question_number = await self.scripts["rewind"](
+                keys=[chat_id, report_key(chat_id)], args=[SESSION_TTL]
+            )
+        return question_number if question_number >= 0 else None
+
+    async def clear_responses(self, chat_id):
+        await self.redis.delete(chat_id, report_key(chat_id))
+
+    @contextlib.asynccontextmanager
+    async def chat_lock(self, chat_id):
+        lock = self.redis.lock(**chat_lock_args(chat_id))
+
+        async def renew():
+            while True:
+                await asyncio.sleep(CHAT_LOCK_RENEW)
+                try:
+                    await lock.extend(CHAT_LOCK_TIMEOUT, replace_ttl=True)
+                except Exception as e:
+                    logger.error(f"Error renewing the lock on chat {chat_id}: {e}")
+                    return
+
+        if not await lock.acquire():
+            raise ChatBusy(chat_id)
+
+        renewer = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            renewer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await renewer
+            try:
+                await lock.release()
+            except Exception as e:
+                logger.error(f"Error releasing the lock on chat {chat_id}: {e}")
+
+    async def cache_get(self, namespace, key):
+        try:
+            value = await self.redis.get(f"{namespace}:{key}")
+            if value is None:
+                return None
+
+            pipe = self.redis.pipeline(transaction=False)
+            queue_cache_touch(pipe, namespace, key)
+            await pipe.execute()
+            return value.decode("utf-8")
+        except Exception as e:
+            logger.error(f"Error reading {namespace}: {e}")
+            return None
+
+    async def cache_set(self, namespace, key, value, ttl, max_entries):
+        try:
+            pipe = self.redis.pipeline()
+            queue_cache_write(pipe, namespace, key, value, ttl)
+            size = (await pipe.execute())[-1]
+
+            if size > max_entries:
+                evicted = await self.redis.zpopmin(
+                    f"{namespace}:lru", size - max_entries
+                )
+                if evicted:
+                    await self.redis.delete(*cache_evicted_keys(namespace, evicted))
+        except Exception as e:
+            logger.error(f"Error writing {namespace}: {e}")
+
+    async def cache_record(self, namespace, hit):
+        try:
+            await self.redis.incr(cache_counter_key(namespace, hit))
+        except Exception as e:
+            logger.error(f"Error counting {namespace}: {e}")
+
+    async def acquire_openai_slot(self, budget, deadline):
+        lease = uuid.uuid4().hex
+        while True:
+            wait_ms = await self.scripts["acquire_openai"](
+                **openai_slot_args(budget, lease)
+            )
+            if wait_ms == 0:
+                return lease
+            await asyncio.sleep(openai_slot_delay(budget, wait_ms, deadline))
+
+    async def call_openai(self, budget, request):
+        """common.call_openai for a request() that returns a coroutine."""
+        deadline = time.monotonic() + OPENAI_QUEUE_TIMEOUT
+
+        for attempt in range(OPENAI_MAX_ATTEMPTS):
+            lease = await self.acquire_openai_slot(budget, deadline)
+            started = time.monotonic()
+            try:
+                result = await request()
+            except Exception as e:
+                throttled, delay = openai_retry(budget, e, attempt, deadline)
+                if throttled:
+                    await self.scripts["adjust_openai"](**openai_limit_args(budget, True))
+                if delay is None:
+                    raise
+            else:
+                if openai_was_fast(budget, started):
+                    await self.scripts["adjust_openai"](**openai_limit_args(budget, False))
+                return result
+            finally:
+                await self.redis.zrem(openai_lease_key(budget), lease)
+
+            await asyncio.sleep(delay)
+
+    async def get_score(self, question, transcription):
+        if question not in prompts:
+            return None
+
+        cache_key = score_cache_key(question, transcription)
+        score = get_local_score(cache_key)
+        if score is None:
+            score = await self.cache_get("score_cache", cache_key)
+            if score is not None:
+                score = int(score)
+                set_local_score(cache_key, score)
+        await self.cache_record("score_cache", score is not None)
+        if score is not None:
+            return score
+
+        try:
+            async with self.timed("score"):
+                response = await self.call_openai(
+                    "chat",
+                    lambda: self.openai.chat.completions.create(
+                        **score_request(question, transcription)
+                    ),
+                )
+
+            score = parse_score(
+                question, transcription, response.choices[0].message.content
+            )
+            if score is None:
+                return 0
+
+            set_local_score(cache_key, score)
+            await self.cache_set(
+                "score_cache", cache_key, score, SCORE_CACHE_TTL, SCORE_CACHE_MAX_ENTRIES
+            )
+            return score
+
+        except Exception as e:
+            logger.error(f"Error generating report: {e}")
+            return None
+
+    async def acquire_telegram_slot(self, chat_id):
+        while True:
+            wait_ms = await self.scripts["acquire_telegram"](**telegram_slot_args(chat_id))
+            if wait_ms == 0:
+                return
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def deliver_message(self, chat_id, message):
+        for attempt in range(TELEGRAM_MAX_ATTEMPTS):
+            await self.acquire_telegram_slot(chat_id)
+            try:
+                async with self.timed("telegram_send"):
+                    return await self.bot.send_message(
+                        **telegram_send_args(chat_id, message)
+                    )
+            except asyncio_helper.ApiTelegramException as e:
+                retry_after = telegram_retry_after(chat_id, e, attempt)
+                if retry_after is None:
+                    raise
+                await asyncio.sleep(retry_after)
+
+    async def send_message(
+        self, chat_id, text, parse_mode=None, reply_markup=None, reply_to=None
+    ):
+        message = outgoing_message(text, parse_mode, reply_markup, reply_to)
+        if TELEGRAM_SEND_MODE != "queue":
+            await self.deliver_message(chat_id, message)
+            return
+
+        pipe = self.redis.pipeline()
+        queue_outbox_message(pipe, chat_id, message)
+        scheduled = (await pipe.execute())[-1]
+        if scheduled:
+            await self.blocking(deliver_messages.delay, chat_id)
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        await self.bot.answer_callback_query(callback_query_id, text)
+
+    async def get_file(self, file_id):
+        async with self.timed("telegram_get_file"):
+            return await self.bot.get_file(file_id)
+
+    async def blocking(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+
+class DropBusyUpdates(ExceptionHandler):
+    """Drop an update whose chat stayed locked, and ask the candidate to
+    send it again; queued updates are retried by process_update instead."""
+
+    def __init__(self, io):
+        self.io = io
+
+    async def handle(self, exception):
+        if not isinstance(exception, ChatBusy):
+            return False
+
+        logger.error(f"Dropped an update: {exception}")
+        try:
+            await self.io.send_message(exception.chat_id, CHAT_BUSY_NOTICE)
+        except Exception as e:
+            logger.error(f"Error sending the busy notice to {exception.chat_id}: {e}")
+        return True
+
+
+io_key = web.AppKey("io", AsyncIO)
+bot_key = web.AppKey("bot", AsyncTeleBot)
+updates_key = web.AppKey("updates", set)
+
+
+async def runtime(app):
+    """Create the loop's clients on startup and close them on shutdown."""
+    import httpx
+    import openai
+
+    redis_client = Redis(
+        connection_pool=BlockingConnectionPool.from_url(
+            redis_url, max_connections=ASYNC_REDIS_MAX_CONNECTIONS
+        )
+    )
+    openai_client = openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        ),
+        max_retries=0,
+    )
+    bot = AsyncTeleBot(BOT_TOKEN)
+    io = AsyncIO(redis_client, bot, openai_client)
+    bot.exception_handler = DropBusyUpdates(io)
+    register_handlers(bot, io)
+    app[io_key] = io
+    app[bot_key] = bot
+    app[updates_key] = set()
+
+    yield
+
+    # Let updates still being handled finish before their clients close
+    await asyncio.gather(*app[updates_key], return_exceptions=True)
+    if asyncio_helper.session_manager.session is not None:
+        await bot.close_session()
+    await openai_client.close()
+    await redis_client.aclose()
+
+
+async def webhook(request):
+    """Webhook to handle incoming updates from Telegram."""
+    payload = await request.text()
+    try:
+        update = types.Update.de_json(payload)
+    except Exception as e:
+        logger.error(f"Invalid update payload: {e}")
+        return web.Response(status=400, text="bad request")
+
+    if update is None or update.update_id is None:
+        return web.Response(status=400, text="bad request")
+
+    io = request.app[io_key]
+    # Telegram redelivers updates it did not see acknowledged in time
+    if not await io.claim_update(update.update_id):
+        return web.Response(text="ok")
+
+    try:
+        async with io.timed("webhook"):
+            if WEBHOOK_MODE == "queue":
+                await io.blocking(process_update.delay, payload)
+            else:
+                # Acknowledge now, like the threaded TeleBot, and handle the
+                # update on the loop
+                updates = request.app[updates_key]
+                handling = asyncio.create_task(
+                    request.app[bot_key].process_new_updates([update])
+                )
+                updates.add(handling)
+                handling.add_done_callback(updates.discard)
+    except Exception as e:
+        # Let the update through again, and have Telegram redeliver it
+        logger.error(f"Error handing off update {update.update_id}: {e}")
+        await io.release_update(update.update_id)
+        return web.Response(status=500, text="error")
+    return web.Response(text="ok")
+
+
+async def metrics_endpoint(request):
+    """Prometheus scrape target, aggregated across all web and worker processes."""
+    body = await asyncio.to_thread(render_metrics)
+    return web.Response(
+        body=body.encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4"},
+    )
+
+
+app = web.Application()
+app.cleanup_ctx.append(runtime)
+app.router.add_post(f"/{WEBHOOK_SECRET}", webhook)
+app.router.add_get("/metrics", metrics_endpoint)
+
+
+if __name__ == "__main__":
+    web.run_app(app)
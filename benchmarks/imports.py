@@ -0,0 +1,83 @@
+"""Cold-start import benchmark for the web and worker entry points.
+
+Usage: python -m benchmarks.imports [--runs 5] [--top 15]
+
+Each entry point is imported in a fresh interpreter, the way a dyno
+restart would, and the median wall time is reported. The slowest
+top-level imports from `python -X importtime` are listed for the last run,
+along with which heavy dependencies each process ended up loading.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = {"web": "main", "web_async": "async_main", "worker": "celery_worker"}
+HEAVY_MODULES = ("flask", "openai", "httpx", "ffmpeg", "smtplib", "handlers")
+
+# Import-time settings only need to parse, nothing is contacted
+ENV = {
+    "BOT_TOKEN": "123456:import-benchmark",
+    "WEBHOOK_SECRET": "import-benchmark",
+    "TO_EMAIL": "['team@example.com']",
+}
+
+
+def import_once(module):
+    code = (
+        f"import sys, time; t = time.perf_counter(); import {module}; "
+        f"print(time.perf_counter() - t); "
+        f"print('loaded:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env={**os.environ, **ENV},
+        check=True,
+    )
+    total = time.perf_counter() - started
+    import_time, loaded = result.stdout.strip().splitlines()[-2:]
+    return float(import_time), total, loaded[len("loaded:"):], result.stderr
+
+
+def slowest(importtime_log, top):
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, raw = line[len("import time:"):].split("|")
+        # importtime indents nested imports past the single leading space
+        if raw[1:].startswith(" "):
+            continue
+        rows.append((int(cumulative), raw.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    for role, module in ENTRY_POINTS.items():
+        imports, totals = [], []
+        for _ in range(args.runs):
+            import_time, total, loaded, log = import_once(module)
+            imports.append(import_time)
+            totals.append(total)
+
+        print(f"{role} ({module}): import {statistics.median(imports) * 1000:.0f} ms, "
+              f"interpreter start to exit {statistics.median(totals) * 1000:.0f} ms "
+              f"(median of {args.runs})")
+        print(f"  heavy modules loaded: {loaded or 'none'}")
+        for cumulative, name in slowest(log, args.top):
+            print(f"  {cumulative / 1000:>8.1f} ms  {name}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
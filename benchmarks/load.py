@@ -0,0 +1,528 @@
+"""End-to-end load benchmark for the interview flow.
+
+Usage: python -m benchmarks.load [--candidates 50] [--concurrency 10]
+           [--telegram-latency 50] [--openai-latency 500]
+           [--whisper-latency 1500] [--smtp-latency 100] [--external-worker]
+           [--server sync|async]
+
+Starts local stand-ins for the Telegram Bot API, OpenAI and SMTP, points
+the bot at them and drives the real webhook() route with synthetic
+updates: text answers, voice answers (a generated Opus clip, uploaded to
+Whisper as is like a real voice note), button callbacks and the final
+submit. Each simulated candidate waits for the bot's reply before
+sending the next answer, the way a person would, and answers the last
+question a second time before submitting. With --server async the
+updates go over HTTP to async_main's aiohttp app instead, served on its
+own event loop.
+
+Redis is real: REDIS_URL must point at a running server. Celery tasks
+run eagerly inside this process by default. With --external-worker they
+go through the broker instead; start the IO and transcode workers with
+the environment this script prints so they talk to the same stand-ins.
+
+Settings such as the OpenAI limiter budgets (OPENAI_WHISPER_RPM, ...),
+the Telegram send limits (TELEGRAM_CHAT_RATE, ...), SCORING_MODE,
+TELEGRAM_SEND_MODE and AUDIO_ANSWER_MODE are read from the environment
+as usual. Simulated candidates answer instantly, so raise the limits to
+benchmark the pipeline rather than the limiters.
+
+Reports latency percentiles per stage (webhook ack, and time to the
+bot's reply for text, voice, button and submit) plus completed
+interviews per second.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_TOKEN = "123456:benchmark"
+WEBHOOK_SECRET = "benchmark"
+TEXT_TIMEOUT = 120
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """Just enough of the Bot API for the handlers, recording every reply."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency, clips):
+        super().__init__(address, FakeTelegramHandler)
+        self.latency = latency
+        # Every file gets its own clip so the transcription cache only hits
+        # when the same file really is sent twice
+        self.clips = itertools.cycle(clips)
+        self.files = {}
+        self.files_lock = threading.Lock()
+        self.replies = defaultdict(queue.Queue)
+        self.message_ids = itertools.count(1)
+        self.calls = defaultdict(int)
+
+
+    def clip(self, path):
+        name = path.rsplit("/", 1)[-1]
+        with self.files_lock:
+            if name not in self.files:
+                self.files[name] = next(self.clips)
+            return self.files[name]
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def params(self):
+        parsed = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Type", "").startswith(
+                "application/x-www-form-urlencoded"
+            ):
+                params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        return parsed.path, params
+
+    def reply(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.server
+        path, params = self.params()
+        time.sleep(server.latency)
+
+        if path.startswith("/file/"):
+            server.calls["download"] += 1
+            self.reply(server.clip(path), "audio/ogg")
+            return
+
+        method = path.rsplit("/", 1)[-1]
+        server.calls[method] += 1
+
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            server.replies[chat_id].put((time.monotonic(), params.get("text", "")))
+            result = {
+                "message_id": next(server.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif method == "getFile":
+            file_path = f"voice/{params['file_id']}.oga"
+            result = {
+                "file_id": params["file_id"],
+                "file_unique_id": params["file_id"],
+                "file_size": len(server.clip(file_path)),
+                "file_path": file_path,
+            }
+        else:
+            result = True
+
+        self.reply(json.dumps({"ok": True, "result": result}).encode())
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, chat_latency, whisper_latency):
+        super().__init__(address, FakeOpenAIHandler)
+        self.chat_latency = chat_latency
+        self.whisper_latency = whisper_latency
+        self.calls = defaultdict(int)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        if self.path.endswith("/audio/transcriptions"):
+            server.calls["transcriptions"] += 1
+            time.sleep(server.whisper_latency)
+            # Unique text so the score cache does not hide the LLM cost
+            result = {"text": f"We would play and build rapport {uuid.uuid4().hex}"}
+        else:
+            server.calls["chat"] += 1
+            time.sleep(server.chat_latency)
+            if b'"json_object"' in body:
+                numbers = re.findall(rb"## Answer (\d+)", body)
+                content = json.dumps(
+                    {
+                        "scores": {n.decode(): 10 for n in numbers},
+                        "city": "Springfield" if b"## Location" in body else None,
+                    }
+                )
+            elif b"Extract a city" in body:
+                content = "Springfield"
+            else:
+                content = "10"
+            result = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "gpt-3.5-turbo-0125",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+
+        payload = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeSMTP(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency):
+        super().__init__(address, FakeSMTPHandler)
+        self.latency = latency
+        self.messages = 0
+        self.connections = 0
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Plain SMTP without TLS; accepts any login and every message."""
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.send("220 localhost benchmark")
+        for raw in self.rfile:
+            command = raw.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.send("250-localhost")
+                self.send("250 AUTH PLAIN LOGIN")
+            elif command.startswith("AUTH"):
+                self.send("235 Authentication successful")
+            elif command.startswith("DATA"):
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                for line in self.rfile:
+                    if line in (b".\r\n", b".\n"):
+                        break
+                time.sleep(server.latency)
+                server.messages += 1
+                self.send("250 OK")
+            elif command.startswith("QUIT"):
+                self.send("221 Bye")
+                return
+            else:
+                self.send("250 OK")
+
+
+def generate_voice_note(seconds, frequency):
+    """A short Opus clip like the ones Telegram clients record."""
+    import ffmpeg
+
+    out, _ = (
+        ffmpeg.input(f"sine=frequency={frequency}:duration={seconds}", f="lavfi")
+        .output("pipe:1", format="ogg", acodec="libopus", ac=1)
+        .global_args("-loglevel", "error")
+        .run(capture_stdout=True)
+    )
+    return out
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class AsyncWebhookClient:
+    """Serves async_main's app on a background event loop and posts to it
+    over HTTP, in place of Flask's test client."""
+
+    def __init__(self, port):
+        import async_main
+        from aiohttp import web
+
+        self.url = f"http://127.0.0.1:{port}"
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(async_main.app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def post(self, path, data, content_type):
+        import requests
+
+        return requests.post(
+            f"{self.url}{path}", data=data, headers={"Content-Type": content_type}
+        )
+
+
+class Candidate:
+    """One simulated applicant walking through every question."""
+
+    update_ids = itertools.count(random.randrange(1 << 40))
+
+    def __init__(self, bench, chat_id):
+        self.bench = bench
+        self.chat_id = chat_id
+        self.replies = bench.telegram.replies[chat_id]
+
+    def post(self, update):
+        update["update_id"] = next(self.update_ids)
+        started = time.monotonic()
+        response = self.bench.client.post(
+            f"/{WEBHOOK_SECRET}",
+            data=json.dumps(update),
+            content_type="application/json",
+        )
+        self.bench.record("webhook_ack", time.monotonic() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook returned {response.status_code}")
+        return started
+
+    def message(self, **fields):
+        return {
+            "message_id": random.randrange(1 << 30),
+            "date": int(time.time()),
+            "chat": {"id": self.chat_id, "type": "private"},
+            "from": {"id": self.chat_id, "is_bot": False, "first_name": "Bench"},
+            **fields,
+        }
+
+    def wait_for(self, expected, started, stage):
+        deadline = time.monotonic() + TEXT_TIMEOUT
+        while True:
+            received_at, text = self.replies.get(timeout=deadline - time.monotonic())
+            # A queued reply may arrive merged with the messages before it
+            if text == expected or text.endswith(f"\n\n{expected}"):
+                self.bench.record(stage, received_at - started)
+                return
+
+    def send_text(self, text, expected):
+        started = self.post({"message": self.message(text=text)})
+        self.wait_for(expected, started, "text_reply")
+
+    def send_voice(self, question_number, expected, file_id=None):
+        file_id = file_id or f"voice-{self.chat_id}-{question_number}-{uuid.uuid4().hex[:8]}"
+        voice = {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "duration": round(self.bench.args.voice_seconds),
+            "mime_type": "audio/ogg",
+        }
+        started = self.post({"message": self.message(voice=voice)})
+        self.wait_for(expected, started, "voice_reply")
+        return file_id
+
+    def press(self, data, expected, stage="button_reply"):
+        started = self.post(
+            {
+                "callback_query": {
+                    "id": str(random.randrange(1 << 30)),
+                    "from": {"id": self.chat_id, "is_bot": False, "first_name": "Bench"},
+                    "chat_instance": str(self.chat_id),
+                    "data": data,
+                    "message": self.message(text="keyboard"),
+                }
+            }
+        )
+        self.wait_for(expected, started, stage)
+
+    def run(self):
+        questions = self.bench.common.questions
+        done = "Thank you! All your responses have been recorded. Would you like to submit your application?"
+
+        started = self.post({"message": self.message(text="/start")})
+        self.wait_for(questions[0], started, "text_reply")
+
+        for i in range(len(questions)):
+            expected = questions[i + 1] if i + 1 < len(questions) else done
+            if i == 3:
+                self.press("1+ years", expected)
+            elif i == 5:
+                self.press("5_Yes", expected)
+            elif i in self.bench.common.prompts:
+                last_voice = self.send_voice(i, expected)
+            else:
+                self.send_text(f"Answer {i} from {self.chat_id}", expected)
+
+        # Answer the last question again with the same recording: its
+        # transcription and score come from the caches, which submit has
+        # to handle without a batched call
+        self.press("last_question", questions[-1])
+        self.send_voice(len(questions) - 1, done, last_voice)
+
+        self.press("send_email", "Details submitted successfully.", "submit_reply")
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+        self.telegram = start(
+            FakeTelegram(
+                ("127.0.0.1", args.port_base),
+                args.telegram_latency / 1000,
+                [
+                    generate_voice_note(args.voice_seconds, 200 + i)
+                    for i in range(args.candidates * 3)
+                ],
+            )
+        )
+        self.openai = start(
+            FakeOpenAI(
+                ("127.0.0.1", args.port_base + 1),
+                args.openai_latency / 1000,
+                args.whisper_latency / 1000,
+            )
+        )
+        self.smtp = start(FakeSMTP(("127.0.0.1", args.port_base + 2), args.smtp_latency / 1000))
+
+        env = {
+            "BOT_TOKEN": BOT_TOKEN,
+            "WEBHOOK_SECRET": WEBHOOK_SECRET,
+            "WEBHOOK_MODE": args.webhook_mode,
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{args.port_base}",
+            "OPENAI_API_KEY": "benchmark",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{args.port_base + 1}/v1",
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(args.port_base + 2),
+            "SMTP_LOGIN": "benchmark",
+            "SMTP_PASSWORD": "benchmark",
+            "SMTP_STARTTLS": "false",
+            "FROM_EMAIL": "bot@example.com",
+            "TO_EMAIL": "['team@example.com']",
+        }
+        os.environ.update(env)
+
+        import common
+        import main
+
+        self.common = common
+        if args.external_worker:
+            prefix = " ".join(f'{k}="{v}"' for k, v in env.items())
+            print("Start the workers with:")
+            print(prefix, "celery -A celery_worker.celery worker -Q celery,email -P threads -c 64 -n io@%h")
+            print(prefix, "celery -A celery_worker.celery worker -Q transcode --prefetch-multiplier 1 -n transcode@%h")
+        else:
+            common.celery.conf.task_always_eager = True
+        if args.server == "async":
+            self.client = AsyncWebhookClient(args.port_base + 3)
+        else:
+            self.client = main.app.test_client()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def run(self):
+        chat_ids = queue.Queue()
+        base = random.randrange(10**9, 2 * 10**9)
+        for i in range(self.args.candidates):
+            chat_ids.put(base + i)
+
+        completed = []
+        failures = []
+
+        def drive():
+            while True:
+                try:
+                    chat_id = chat_ids.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    Candidate(self, chat_id).run()
+                    completed.append(chat_id)
+                except Exception as e:
+                    failures.append((chat_id, repr(e)))
+                finally:
+                    self.common.clear_responses(chat_id)
+
+        started = time.monotonic()
+        drivers = [
+            threading.Thread(target=drive) for _ in range(self.args.concurrency)
+        ]
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            driver.join()
+        elapsed = time.monotonic() - started
+
+        self.report(elapsed, completed, failures)
+
+    def report(self, elapsed, completed, failures):
+        print(f"\n{len(completed)} interviews in {elapsed:.1f}s "
+              f"({len(completed) / elapsed:.2f} interviews/s), {len(failures)} failed")
+        for chat_id, error in failures[:5]:
+            print(f"  chat {chat_id}: {error}")
+
+        print(f"\n{'stage':<16}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage, values in sorted(self.samples.items()):
+            print(
+                f"{stage:<16}{len(values):>8}"
+                + "".join(f"{percentile(values, q) * 1000:>10.0f}" for q in (0.5, 0.9, 0.99))
+                + f"{max(values) * 1000:>10.0f}"
+            )
+
+        print("\nUpstream calls:")
+        for name, count in sorted({**self.telegram.calls, **self.openai.calls}.items()):
+            print(f"  {name:<22}{count:>8}")
+        print(f"  {'smtp connections':<22}{self.smtp.connections:>8}")
+        print(f"  {'smtp messages':<22}{self.smtp.messages:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--candidates", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--telegram-latency", type=float, default=50, help="ms")
+    parser.add_argument("--openai-latency", type=float, default=500, help="ms")
+    parser.add_argument("--whisper-latency", type=float, default=1500, help="ms")
+    parser.add_argument("--smtp-latency", type=float, default=100, help="ms")
+    parser.add_argument("--voice-seconds", type=float, default=20)
+    parser.add_argument("--webhook-mode", choices=["inline", "queue"], default="inline")
+    parser.add_argument("--port-base", type=int, default=18080)
+    parser.add_argument("--external-worker", action="store_true")
+    parser.add_argument("--server", choices=["sync", "async"], default="sync")
+    Benchmark(parser.parse_args()).run()
+
+
+if __name__ == "__main__":
+    main()
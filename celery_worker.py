@@ -1,4 +1,9 @@
-from main import celery
+"""Worker entry point. Imports only the tasks, never the Flask app."""
+from common import bot
+from tasks import celery
+
+# Queued updates are handled inside the task rather than on the bot's thread pool
+bot.threaded = False
 
 if __name__ == "__main__":
     celery.start()
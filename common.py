@@ -0,0 +1,1669 @@
+"""Shared state for the web and worker processes.
+
+Configuration, Redis, the Celery app, the bot, the questionnaire, session
+state, caches, metrics and OpenAI scoring live here. Heavy dependencies
+that only some code paths need (openai, httpx) are imported on first use
+so both entry points start quickly.
+"""
+import os
+import threading
+import random
+import uuid
+from telebot import TeleBot, apihelper, types
+import logging
+from redis import Redis, ConnectionPool
+import time
+import json
+import hashlib
+import re
+from collections import OrderedDict
+import contextlib
+import requests
+from celery import Celery
+from celery.signals import task_prerun, task_postrun
+from dotenv import load_dotenv
+
+from questionnaire import questionnaire, rubric_scores, rubric_template, submit_prompt
+
+load_dotenv()
+
+# APP SET UP
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+pool = ConnectionPool.from_url(redis_url)
+
+celery = Celery(
+    "querypro",
+    broker=redis_url,
+    backend=os.environ.get("CELERY_RESULT_BACKEND", redis_url),
+)
+
+# Network-bound tasks (Bot API, Whisper, chat completions) run on the
+# default queue, served by a thread pool with high concurrency. ffmpeg
+# work runs on TRANSCODE_QUEUE, served by a prefork pool sized to the
+# CPUs, so a few slow transcodes never hold up the cheap tasks.
+IO_QUEUE = os.environ.get("IO_QUEUE", "celery")
+TRANSCODE_QUEUE = os.environ.get("TRANSCODE_QUEUE", "transcode")
+EMAIL_QUEUE = "email"
+celery.conf.task_default_queue = IO_QUEUE
+celery.conf.task_routes = {
+    "tasks.deliver_email": {"queue": EMAIL_QUEUE},
+    "tasks.prepare_audio": {"queue": TRANSCODE_QUEUE},
+}
+# Chains pass results along in their messages; the backend only stores
+# results for tasks that opt in with ignore_result=False.
+celery.conf.task_ignore_result = True
+celery.conf.result_expires = 3600
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+BOT_TOKEN = os.environ.get("BOT_TOKEN")
+# Point at a self-hosted Bot API server or a local stand-in for benchmarks
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 20))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", 10))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 60))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 60))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 5))
+
+OPENAI_QUEUE_TIMEOUT = float(os.environ.get("OPENAI_QUEUE_TIMEOUT", 300))
+OPENAI_MAX_ATTEMPTS = int(os.environ.get("OPENAI_MAX_ATTEMPTS", 6))
+
+# Shared across every web and worker process through Redis
+openai_budgets = {
+    "chat": {
+        "rpm": int(os.environ.get("OPENAI_CHAT_RPM", 500)),
+        "burst": int(os.environ.get("OPENAI_CHAT_BURST", 50)),
+        "max_concurrency": int(os.environ.get("OPENAI_CHAT_CONCURRENCY", 32)),
+        "latency_target": float(os.environ.get("OPENAI_CHAT_LATENCY_TARGET", 10)),
+    },
+    "whisper": {
+        "rpm": int(os.environ.get("OPENAI_WHISPER_RPM", 50)),
+        "burst": int(os.environ.get("OPENAI_WHISPER_BURST", 5)),
+        "max_concurrency": int(os.environ.get("OPENAI_WHISPER_CONCURRENCY", 8)),
+        "latency_target": float(os.environ.get("OPENAI_WHISPER_LATENCY_TARGET", 30)),
+    },
+}
+
+UPDATE_DEDUP_TTL = int(os.environ.get("UPDATE_DEDUP_TTL", 600))
+# A session expires this long after its last answer unless it is submitted,
+# after which it is archived and kept only for SUBMITTED_SESSION_TTL; later
+# rubric changes reach it through `rescore.py --archive`
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 14 * 24 * 3600))
+SUBMITTED_SESSION_TTL = int(os.environ.get("SUBMITTED_SESSION_TTL", 24 * 3600))
+# The chat lock is renewed while its handler runs, so the timeout only
+# bounds how long a crashed holder keeps the chat blocked
+CHAT_LOCK_TIMEOUT = int(os.environ.get("CHAT_LOCK_TIMEOUT", 120))
+CHAT_LOCK_RENEW = CHAT_LOCK_TIMEOUT / 3
+# An update that cannot take its chat's lock within CHAT_LOCK_WAIT is never
+# handled without it: queued updates are retried until CHAT_LOCK_HOLD_MAX,
+# the longest a handler can hold the lock (an OpenAI call queueing and
+# retrying up to OPENAI_QUEUE_TIMEOUT, then its last attempt), has passed,
+# and inline ones are dropped with a notice to the candidate.
+CHAT_LOCK_WAIT = int(os.environ.get("CHAT_LOCK_WAIT", 60))
+CHAT_LOCK_HOLD_MAX = OPENAI_QUEUE_TIMEOUT + OPENAI_TIMEOUT + 30
+CHAT_BUSY_NOTICE = (
+    "We are still working on your previous message. Please send this one again in a moment."
+)
+
+SCORE_CACHE_TTL = int(os.environ.get("SCORE_CACHE_TTL", 30 * 24 * 3600))
+SCORE_CACHE_MAX_ENTRIES = int(os.environ.get("SCORE_CACHE_MAX_ENTRIES", 50000))
+SCORE_LOCAL_CACHE_TTL = int(os.environ.get("SCORE_LOCAL_CACHE_TTL", 3600))
+SCORE_LOCAL_CACHE_MAX_ENTRIES = int(
+    os.environ.get("SCORE_LOCAL_CACHE_MAX_ENTRIES", 1000)
+)
+# per_answer scores each answer and extracts the city as they arrive.
+# deferred and incremental leave them for one batched completion, run at
+# submit or as soon as the last batched question is answered.
+SCORING_MODE = os.environ.get("SCORING_MODE", "per_answer")
+# wait sends the next question once a voice answer is transcribed and
+# scored. optimistic stores it as pending and sends the next question at
+# once; the worker fills the answer in, and submit waits only for answers
+# still pending.
+AUDIO_ANSWER_MODE = os.environ.get("AUDIO_ANSWER_MODE", "wait")
+
+# direct sends each reply from the handler; queue appends it to the chat's
+# outbox and returns, and a deliver_messages task sends the outbox in
+# order, merging consecutive texts.
+TELEGRAM_SEND_MODE = os.environ.get("TELEGRAM_SEND_MODE", "direct")
+# Telegram allows about 30 messages a second per bot and one a second per
+# chat, with short bursts
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_MAX_ATTEMPTS = int(os.environ.get("TELEGRAM_MAX_ATTEMPTS", 5))
+TELEGRAM_MAX_CONNECTIONS = int(os.environ.get("TELEGRAM_MAX_CONNECTIONS", 20))
+# Inline webhook handlers run on this many threads per web process; one
+# waiting on a busy chat's lock holds its thread for up to CHAT_LOCK_WAIT
+TELEGRAM_HANDLER_THREADS = int(os.environ.get("TELEGRAM_HANDLER_THREADS", 16))
+OUTBOX_DRAIN_TIMEOUT = int(os.environ.get("OUTBOX_DRAIN_TIMEOUT", 300))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+if "TELEGRAM_API_URL" in os.environ:
+    apihelper.API_URL = f"{TELEGRAM_API_URL}/bot{{0}}/{{1}}"
+    apihelper.FILE_URL = f"{TELEGRAM_API_URL}/file/bot{{0}}/{{1}}"
+
+# One keep-alive connection pool for every Bot API call and file download
+# in the process, rather than one per thread
+telegram_session = requests.Session()
+telegram_session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=TELEGRAM_MAX_CONNECTIONS)
+)
+telegram_session.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_maxsize=TELEGRAM_MAX_CONNECTIONS)
+)
+apihelper.session = telegram_session
+
+bot = TeleBot(BOT_TOKEN, threaded=True, num_threads=TELEGRAM_HANDLER_THREADS)
+
+SCORE_MODEL = "gpt-3.5-turbo-0125"
+
+
+def rubric_version(prompt):
+    """Changing a prompt changes its version, so scores cached under the
+    old rubric are never returned for the new one."""
+    return hashlib.sha256(f"{SCORE_MODEL}\n{prompt}".encode("utf-8")).hexdigest()[:12]
+
+
+def compile_questionnaire(spec):
+    """Build the lookup table the handlers run from.
+
+    Returns one step per question plus a final submit step, and a map from
+    button callback data to the question, answer text and score it stands
+    for. Reply markups are serialized here once, so sending a question
+    builds no keyboard objects.
+    """
+    navigation = [
+        types.InlineKeyboardButton("Restart", callback_data="restart"),
+        types.InlineKeyboardButton(
+            "Answer Last Question Again", callback_data="last_question"
+        ),
+    ]
+    steps = []
+    choices = {}
+
+    for number, question in enumerate(spec):
+        options = question.get("choices", [])
+        keyboard = types.InlineKeyboardMarkup()
+        if options:
+            keyboard.add(
+                *[
+                    types.InlineKeyboardButton(o["label"], callback_data=o["data"])
+                    for o in options
+                ]
+            )
+        if number != 0:
+            keyboard.add(*navigation)
+
+        prompt = None
+        if "rubric" in question:
+            prompt = rubric_template.format(
+                question=question["text"], rubric=question["rubric"]
+            )
+
+        steps.append(
+            {
+                "number": number,
+                "text": question["text"],
+                "parse_mode": "Markdown",
+                "markup": keyboard.to_json(),
+                "notice": question.get("notice"),
+                "role": question.get("role"),
+                "choices": [o["data"] for o in options],
+                "prompt": prompt,
+                "rubric_version": rubric_version(prompt) if prompt else None,
+                "max_score": max(
+                    [o["score"] for o in options], default=0
+                ) + (max(rubric_scores) if prompt else 0),
+            }
+        )
+        for option in options:
+            choices[option["data"]] = {
+                "question": number,
+                "text": option["label"],
+                "score": option["score"],
+            }
+
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton("Submit Details", callback_data="send_email"))
+    steps.append(
+        {
+            "number": len(spec),
+            "text": submit_prompt,
+            "parse_mode": None,
+            "markup": keyboard.to_json(),
+            "notice": None,
+            "role": None,
+            "choices": [],
+            "prompt": None,
+            "rubric_version": None,
+            "max_score": 0,
+        }
+    )
+    return steps, choices
+
+
+steps, choices = compile_questionnaire(questionnaire)
+questions = [step["text"] for step in steps[:-1]]
+prompts = {step["number"]: step["prompt"] for step in steps if step["prompt"]}
+rubric_versions = {
+    step["number"]: step["rubric_version"] for step in steps if step["prompt"]
+}
+roles = {step["role"]: step["number"] for step in steps if step["role"]}
+max_score = sum(step["max_score"] for step in steps)
+
+
+_openai_client = None
+_openai_client_pid = None
+_openai_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """Return the process-wide OpenAI client, creating it lazily after fork."""
+    global _openai_client, _openai_client_pid
+
+    pid = os.getpid()
+    if _openai_client is None or _openai_client_pid != pid:
+        import httpx
+        import openai
+
+        with _openai_client_lock:
+            if _openai_client is None or _openai_client_pid != pid:
+                http_client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+                    ),
+                    timeout=httpx.Timeout(
+                        OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT
+                    ),
+                )
+                # Retries happen in call_openai so 429s reach the limiter
+                _openai_client = openai.OpenAI(
+                    api_key=OPENAI_API_KEY, http_client=http_client, max_retries=0
+                )
+                _openai_client_pid = pid
+
+    return _openai_client
+
+
+# A request needs both a token from the budget's bucket (requests per
+# minute) and a free slot under its concurrency limit. Slots are leases that
+# expire, so a worker dying mid-request does not leak them.
+acquire_openai_script = Redis(connection_pool=pool).register_script(
+    """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local rate = tonumber(ARGV[1]) / 60000
+local burst = tonumber(ARGV[2])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local limit = tonumber(redis.call('HGET', KEYS[3], 'limit') or ARGV[3])
+if redis.call('ZCARD', KEYS[2]) >= math.max(1, math.floor(limit)) then
+    return 50
+end
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+if tokens < 1 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+    return math.ceil((1 - tokens) / rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', now)
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[4])
+return 0
+"""
+)
+
+# Additive increase while latency stays under target, multiplicative
+# decrease on 429 (at most once a second, since a burst of 429s is one event).
+adjust_openai_script = Redis(connection_pool=pool).register_script(
+    """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'limit', 'decreased_at')
+local limit = tonumber(state[1]) or tonumber(ARGV[2])
+
+if ARGV[1] == '1' then
+    if now - (tonumber(state[2]) or 0) < 1000 then
+        return tostring(limit)
+    end
+    limit = math.max(1, limit / 2)
+    redis.call('HSET', KEYS[1], 'limit', tostring(limit), 'decreased_at', now)
+else
+    limit = math.min(tonumber(ARGV[2]), limit + 1 / limit)
+    redis.call('HSET', KEYS[1], 'limit', tostring(limit))
+end
+return tostring(limit)
+"""
+)
+
+
+# The helpers below hold the limiter and retry logic that call_openai and
+# async_main.AsyncIO.call_openai share; those only make the Redis calls and
+# sleep, blocking or awaiting.
+
+
+def openai_slot_args(budget, lease):
+    """The keys and args for acquire_openai_script."""
+    config = openai_budgets[budget]
+    return {
+        "keys": [
+            f"openai_limiter:{budget}:bucket",
+            f"openai_limiter:{budget}:leases",
+            f"openai_limiter:{budget}:limit",
+        ],
+        "args": [
+            config["rpm"],
+            config["burst"],
+            config["max_concurrency"],
+            lease,
+            int((OPENAI_TIMEOUT + 10) * 1000),
+        ],
+    }
+
+
+def openai_slot_delay(budget, wait_ms, deadline):
+    """Seconds to wait before asking the limiter again, with jitter."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(f"Timed out waiting for the OpenAI {budget} limiter")
+    return min(remaining, wait_ms / 1000 * random.uniform(1, 1.5))
+
+
+def openai_limit_args(budget, throttled):
+    """The keys and args for adjust_openai_script: halve the concurrency
+    limit after a 429, or raise it a little after a fast response."""
+    return {
+        "keys": [f"openai_limiter:{budget}:limit"],
+        "args": [int(throttled), openai_budgets[budget]["max_concurrency"]],
+    }
+
+
+def openai_lease_key(budget):
+    return f"openai_limiter:{budget}:leases"
+
+
+def openai_was_fast(budget, started):
+    return time.monotonic() - started <= openai_budgets[budget]["latency_target"]
+
+
+def openai_retry(budget, error, attempt, deadline):
+    """Decide what follows a failed OpenAI attempt.
+
+    Returns (throttled, delay): throttled if OpenAI rate limited the
+    request, and delay the seconds to back off before the next attempt, or
+    None once the error is not retryable, the attempts are used up or the
+    wait would run past the deadline.
+    """
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        throttled = True
+        retry_after = error.response.headers.get("retry-after")
+        delay = float(retry_after) if retry_after else 2 ** attempt
+    elif isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        throttled = False
+        delay = 2 ** attempt
+    else:
+        return False, None
+
+    if attempt == OPENAI_MAX_ATTEMPTS - 1:
+        return throttled, None
+    delay *= random.uniform(1, 1.5)
+    if time.monotonic() + delay > deadline:
+        return throttled, None
+
+    logger.error(f"OpenAI {budget} request failed, retrying in {delay:.1f}s: {error}")
+    return throttled, delay
+
+
+def acquire_openai_slot(redis_client, budget, deadline):
+    """Wait for a rate-limit token and a concurrency slot; return the lease id."""
+    lease = uuid.uuid4().hex
+    while True:
+        wait_ms = acquire_openai_script(
+            **openai_slot_args(budget, lease), client=redis_client
+        )
+        if wait_ms == 0:
+            return lease
+        time.sleep(openai_slot_delay(budget, wait_ms, deadline))
+
+
+def call_openai(budget, request):
+    """Run request() under the cluster-wide rate limiter for budget.
+
+    Callers queue for capacity instead of failing. Rate-limit, timeout,
+    connection and server errors are retried with backoff until
+    OPENAI_MAX_ATTEMPTS or OPENAI_QUEUE_TIMEOUT runs out.
+    """
+    deadline = time.monotonic() + OPENAI_QUEUE_TIMEOUT
+    redis_client = Redis(connection_pool=pool)
+
+    try:
+        for attempt in range(OPENAI_MAX_ATTEMPTS):
+            lease = acquire_openai_slot(redis_client, budget, deadline)
+            started = time.monotonic()
+            try:
+                result = request()
+            except Exception as e:
+                throttled, delay = openai_retry(budget, e, attempt, deadline)
+                if throttled:
+                    adjust_openai_script(
+                        **openai_limit_args(budget, True), client=redis_client
+                    )
+                if delay is None:
+                    raise
+            else:
+                if openai_was_fast(budget, started):
+                    adjust_openai_script(
+                        **openai_limit_args(budget, False), client=redis_client
+                    )
+                return result
+            finally:
+                redis_client.zrem(openai_lease_key(budget), lease)
+
+            time.sleep(delay)
+    finally:
+        redis_client.close()
+
+
+_local_score_cache = OrderedDict()
+_local_score_cache_lock = threading.Lock()
+
+
+def normalize_answer(text):
+    """Lowercase an answer and strip punctuation and repeated whitespace."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def score_cache_key(question, transcription):
+    answer_hash = hashlib.sha256(
+        normalize_answer(transcription).encode("utf-8")
+    ).hexdigest()
+    return f"{question}:{rubric_versions[question]}:{answer_hash}"
+
+
+def get_local_score(key):
+    """Look up a score in the in-process LRU."""
+    with _local_score_cache_lock:
+        entry = _local_score_cache.get(key)
+        if entry is not None:
+            score, expires_at = entry
+            if expires_at > time.monotonic():
+                _local_score_cache.move_to_end(key)
+                return score
+            del _local_score_cache[key]
+    return None
+
+
+def get_cached_score(key):
+    """Look up a score in the in-process LRU, then in Redis."""
+    score = get_local_score(key)
+    if score is not None:
+        return score
+
+    score = cache_get("score_cache", key)
+    if score is None:
+        return None
+
+    score = int(score)
+    set_local_score(key, score)
+    return score
+
+
+def set_local_score(key, score):
+    with _local_score_cache_lock:
+        _local_score_cache[key] = (score, time.monotonic() + SCORE_LOCAL_CACHE_TTL)
+        _local_score_cache.move_to_end(key)
+        while len(_local_score_cache) > SCORE_LOCAL_CACHE_MAX_ENTRIES:
+            _local_score_cache.popitem(last=False)
+
+
+def score_request(question, transcription):
+    """The chat completion arguments that score an answer against its rubric."""
+    return {
+        "model": SCORE_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompts[question]
+                    }
+                ],
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": transcription
+                    }
+                ],
+            },
+        ],
+        "temperature": 0.7,
+    }
+
+
+def parse_score(question, transcription, report):
+    """The rubric score a completion gave, or None if it is not one."""
+    try:
+        score = int(report)
+    except (TypeError, ValueError):
+        score = None
+
+    if score in rubric_scores:
+        print('success', prompts[question], transcription, report, score)
+        return score
+
+    print('fail', prompts[question], transcription, report, score)
+    return None
+
+
+def get_score(question, transcription, use_cache=True):
+    """Generate a report based on the transcription using GPT-3.5.
+
+    With use_cache=False the score cache is not read, only refreshed with
+    the new score.
+    """
+
+    if question not in prompts:
+        return None
+
+    cache_key = score_cache_key(question, transcription)
+    if use_cache:
+        score = get_cached_score(cache_key)
+        cache_record("score_cache", score is not None)
+        if score is not None:
+            return score
+
+    try:
+        openai_client = get_openai_client()
+        with timed("score"):
+            response = call_openai(
+                "chat",
+                lambda: openai_client.chat.completions.create(
+                    **score_request(question, transcription)
+                ),
+            )
+
+        score = parse_score(
+            question, transcription, response.choices[0].message.content
+        )
+        if score is None:
+            return 0
+
+        set_local_score(cache_key, score)
+        cache_set(
+            "score_cache", cache_key, score, SCORE_CACHE_TTL, SCORE_CACHE_MAX_ENTRIES
+        )
+        return score
+
+    except Exception as e:
+        logger.error(f"Error generating report: {e}")
+        return None
+
+
+def get_city(transcription):
+    """Generate a report based on the transcription using GPT-3.5."""
+    try:
+        openai_client = get_openai_client()
+        with timed("city"):
+            response = call_openai(
+                "chat",
+                lambda: openai_client.chat.completions.create(
+                    model="gpt-3.5-turbo-0125",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "text": "Extract a city from the given prompt, reply with either only the city name or 'None' in case of failure"
+                                }
+                            ],
+                        },
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "text": transcription
+                                }
+                            ],
+                        },
+                    ],
+                    temperature=0,
+                ),
+            )
+        report = response.choices[0].message.content
+
+        try:
+            if report == 'None':
+                return None
+
+            return report                
+        except:
+            pass
+
+        return 0
+    
+    except Exception as e:
+        logger.error(f"Error generating report: {e}")
+        return None
+
+
+def batch_score(answers, location=None):
+    """Score several answers and extract the city in one JSON completion.
+
+    answers maps question numbers to answer text; location is the answer
+    to extract the city from, if it is still needed. Returns a dict of
+    question number to score, plus "city" (None if there is none), holding
+    only the fields that came back valid, so callers can fall back to
+    get_score and get_city for the rest. Valid scores are cached like
+    single-question ones.
+    """
+    if not answers and location is None:
+        return {}
+
+    sections = []
+    for question, text in sorted(answers.items()):
+        spec = questionnaire[question]
+        sections.append(
+            f"## Answer {question}\nQuestion: {spec['text']}\n"
+            f"Points breakdown:\n{spec['rubric']}\nAnswer:\n{text}"
+        )
+    if location is not None:
+        sections.append(f"## Location\n{location}")
+
+    instructions = (
+        "You score a job candidate's interview answers. Score each numbered "
+        f"answer with one of {', '.join(map(str, rubric_scores))} following its "
+        "points breakdown. If a location is given, extract the city from it. "
+        'Reply with a JSON object like {"scores": {"<answer number>": <score>}, '
+        '"city": "<city name or null>"}.'
+    )
+
+    try:
+        openai_client = get_openai_client()
+        with timed("batch_score"):
+            response = call_openai(
+                "chat",
+                lambda: openai_client.chat.completions.create(
+                    model=SCORE_MODEL,
+                    messages=[
+                        {"role": "system", "content": instructions},
+                        {"role": "user", "content": "\n\n".join(sections)},
+                    ],
+                    response_format={"type": "json_object"},
+                    temperature=0,
+                ),
+            )
+        result = json.loads(response.choices[0].message.content)
+    except Exception as e:
+        logger.error(f"Error batch scoring: {e}")
+        return {}
+    if not isinstance(result, dict):
+        return {}
+
+    fields = {}
+    scores = result.get("scores")
+    for question, text in answers.items():
+        score = scores.get(str(question)) if isinstance(scores, dict) else None
+        if isinstance(score, int) and score in rubric_scores:
+            fields[question] = score
+            cache_key = score_cache_key(question, text)
+            set_local_score(cache_key, score)
+            cache_set(
+                "score_cache", cache_key, score, SCORE_CACHE_TTL, SCORE_CACHE_MAX_ENTRIES
+            )
+
+    if location is not None and "city" in result:
+        city = result["city"]
+        if city is None or city in ("", "None"):
+            fields["city"] = None
+        elif isinstance(city, str):
+            fields["city"] = city.strip()
+    return fields
+
+
+# Each chat is one hash: "cursor" holds the index of the question being
+# answered and "question_<n>" holds each saved answer as compact JSON.
+# Sessions written before the cursor existed fall back to counting their
+# answers.
+SESSION_CURSOR_LUA = """
+local cursor = redis.call('HGET', KEYS[1], 'cursor')
+if cursor then
+    cursor = tonumber(cursor)
+else
+    cursor = redis.call('HLEN', KEYS[1])
+end
+"""
+
+# Each answer's part of the emailed report is rendered when the answer is
+# written and kept beside the session in "report:<chat_id>": the HTML in
+# "fragment_<n>", the score in "score_<n>" and their running sum in
+# "total". Submitting then only joins them. ARGV is the question number,
+# the answer, its fragment and its score ('' for none).
+REPORT_FRAGMENT_LUA = """
+local previous = tonumber(redis.call('HGET', KEYS[2], 'score_' .. ARGV[1])) or 0
+redis.call('HSET', KEYS[2], 'fragment_' .. ARGV[1], ARGV[3])
+if ARGV[4] == '' then
+    redis.call('HDEL', KEYS[2], 'score_' .. ARGV[1])
+else
+    redis.call('HSET', KEYS[2], 'score_' .. ARGV[1], ARGV[4])
+end
+redis.call('HINCRBY', KEYS[2], 'total', (tonumber(ARGV[4]) or 0) - previous)
+"""
+
+# Writes by the candidate push both keys' expiry out to the TTL given as
+# the last ARGV. Background updates leave it alone.
+SESSION_EXPIRY_LUA = """
+redis.call('EXPIRE', KEYS[1], ARGV[#ARGV])
+redis.call('EXPIRE', KEYS[2], ARGV[#ARGV])
+"""
+
+save_answer_script = Redis(connection_pool=pool).register_script(
+    SESSION_CURSOR_LUA
+    + """
+if cursor ~= tonumber(ARGV[1]) then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'question_' .. ARGV[1], ARGV[2], 'cursor', cursor + 1)
+"""
+    + REPORT_FRAGMENT_LUA
+    + SESSION_EXPIRY_LUA
+    + """
+return cursor + 1
+"""
+)
+
+update_answer_script = Redis(connection_pool=pool).register_script(
+    """
+if redis.call('HGET', KEYS[1], 'question_' .. ARGV[1]) ~= ARGV[5] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'question_' .. ARGV[1], ARGV[2])
+"""
+    + REPORT_FRAGMENT_LUA
+    + """
+return 1
+"""
+)
+
+rewind_script = Redis(connection_pool=pool).register_script(
+    SESSION_CURSOR_LUA
+    + """
+if cursor <= 0 then
+    return -1
+end
+cursor = cursor - 1
+redis.call('HDEL', KEYS[1], 'question_' .. cursor)
+redis.call('HSET', KEYS[1], 'cursor', cursor)
+local previous = tonumber(redis.call('HGET', KEYS[2], 'score_' .. cursor)) or 0
+redis.call('HDEL', KEYS[2], 'fragment_' .. cursor, 'score_' .. cursor)
+redis.call('HINCRBY', KEYS[2], 'total', -previous)
+"""
+    + SESSION_EXPIRY_LUA
+    + """
+return cursor
+"""
+)
+
+
+# Counts the answers in KEYS[1] that the worker has yet to fill in. A
+# pending answer is stored as {"pending":"<token>"}; in any other answer
+# that sequence could only appear escaped.
+PENDING_ANSWERS_LUA = """
+local pending = 0
+local fields = redis.call('HGETALL', KEYS[1])
+for i = 1, #fields, 2 do
+    if string.sub(fields[i], 1, 9) == 'question_'
+        and string.find(fields[i + 1], '"pending":', 1, true) then
+        pending = pending + 1
+    end
+end
+"""
+
+# Returns how many answers a submit has to wait for, flagging the session
+# so that whichever finishes last submits it.
+defer_submit_script = Redis(connection_pool=pool).register_script(
+    PENDING_ANSWERS_LUA
+    + """
+if pending > 0 then
+    redis.call('HSET', KEYS[1], 'submit_requested', 1)
+end
+return pending
+"""
+)
+
+# Replaces a pending answer with its result if it is still the one stored
+# (ARGV[5]). Returns -1 if not, 1 if it was the last pending answer of a
+# deferred submit, else 0.
+resolve_pending_script = Redis(connection_pool=pool).register_script(
+    """
+if redis.call('HGET', KEYS[1], 'question_' .. ARGV[1]) ~= ARGV[5] then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'question_' .. ARGV[1], ARGV[2])
+"""
+    + REPORT_FRAGMENT_LUA
+    + PENDING_ANSWERS_LUA
+    + """
+if pending == 0 and redis.call('HDEL', KEYS[1], 'submit_requested') == 1 then
+    return 1
+end
+return 0
+"""
+)
+
+
+def report_key(chat_id):
+    return f"report:{chat_id}"
+
+
+def dump_answer(answer):
+    """Encode an answer for the session hash."""
+    return json.dumps(answer, separators=(",", ":"), ensure_ascii=False)
+
+
+def render_fragment(question_number, answer):
+    """The emailed report's HTML for one answer."""
+    fragment = (
+        f"<b>Question:</b> {questions[question_number]}"
+        f"<br><b>Answer:</b> {answer.get('text', 'N/A')}"
+    )
+
+    remote_path = answer.get("remote_path", "N/A")
+    if remote_path != "N/A":
+        fragment += f'<br><b>Remote Path:</b> <a href="{remote_path}" target="_blank">Download the voice recording</a>'
+
+    score = answer.get("score")
+    if score is not None:
+        fragment += f"<br><b>Score:</b> {score}<br><br>"
+    else:
+        fragment += "<br><br>"
+    return fragment
+
+
+def answer_args(question_number, answer):
+    """The script arguments that store an answer and its report fragment."""
+    score = answer.get("score")
+    return [
+        question_number,
+        dump_answer(answer),
+        render_fragment(question_number, answer),
+        "" if score is None else score,
+    ]
+
+
+def get_current_question(chat_id):
+    """Return the index of the question the chat is currently answering."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        with timed("redis_session"):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hget(chat_id, "cursor")
+            pipe.hlen(chat_id)
+            cursor, answers = pipe.execute()
+        return int(cursor) if cursor is not None else answers
+    finally:
+        redis_client.close()
+
+
+def save_answer(chat_id, question_number, answer):
+    """Store the answer to question_number and advance the cursor.
+
+    The answer, its report fragment and the cursor are written in one
+    script, and only if the chat is still on that question. Returns the
+    next question index, or None if the answer was stale (the chat had
+    already moved on or been rewound) or Redis failed.
+    """
+    redis_client = Redis(connection_pool=pool)
+    try:
+        with timed("redis_session"):
+            next_question = save_answer_script(
+                keys=[chat_id, report_key(chat_id)],
+                args=answer_args(question_number, answer) + [SESSION_TTL],
+                client=redis_client,
+            )
+        if next_question < 0:
+            print(f"Discarded stale answer to question {question_number} for {chat_id}")
+            return None
+
+        increment("answers_saved_total", question=question_number)
+        return next_question
+
+    except Exception as e:
+        print(f"Error in save_answer {e}")
+        return None
+
+    finally:
+        redis_client.close()
+
+
+def rewind_question(chat_id):
+    """Drop the last answer and move the cursor back to it.
+
+    Returns the question to ask again, or None if nothing was answered yet.
+    """
+    redis_client = Redis(connection_pool=pool)
+    try:
+        with timed("redis_session"):
+            question_number = rewind_script(
+                keys=[chat_id, report_key(chat_id)],
+                args=[SESSION_TTL],
+                client=redis_client,
+            )
+        return question_number if question_number >= 0 else None
+    finally:
+        redis_client.close()
+
+
+def clear_responses(chat_id):
+    redis_client = Redis(connection_pool=pool)
+    redis_client.delete(chat_id, report_key(chat_id))
+    redis_client.close()
+
+
+def update_answer(chat_id, question_number, answer, fields):
+    """Merge fields into a stored answer, unless its text has changed since.
+
+    Background work (city extraction, re-scoring) uses this so that a
+    result computed for an old answer never lands on a newer one. The
+    report fragment and total are updated with it. Returns True if the
+    answer was updated.
+    """
+    redis_client = Redis(connection_pool=pool)
+    try:
+        # Retry if the answer changes between reading and writing it
+        while True:
+            stored = redis_client.hget(chat_id, f"question_{question_number}")
+            if stored is None:
+                return False
+
+            response = json.loads(stored)
+            if response.get("text") != answer:
+                return False
+
+            response.update(fields)
+            if update_answer_script(
+                keys=[chat_id, report_key(chat_id)],
+                args=answer_args(question_number, response) + [stored],
+                client=redis_client,
+            ):
+                return True
+    finally:
+        redis_client.close()
+
+
+def defer_submit(chat_id):
+    """Return how many answers are pending, flagging the session to be
+    submitted when the last of them is filled in."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        return defer_submit_script(keys=[chat_id], client=redis_client)
+    finally:
+        redis_client.close()
+
+
+def resolve_pending(chat_id, question_number, token, answer):
+    """Replace the pending answer stored under token with answer.
+
+    Returns None if the chat rewound or restarted since, True if this was
+    the last pending answer of a deferred submit, which the caller then
+    runs, and False otherwise.
+    """
+    redis_client = Redis(connection_pool=pool)
+    try:
+        stored = redis_client.hget(chat_id, f"question_{question_number}")
+        if stored is None or json.loads(stored).get("pending") != token:
+            return None
+
+        result = resolve_pending_script(
+            keys=[chat_id, report_key(chat_id)],
+            args=answer_args(question_number, answer) + [stored],
+            client=redis_client,
+        )
+        return None if result < 0 else bool(result)
+    finally:
+        redis_client.close()
+
+
+def get_report(chat_id):
+    """Assemble the emailed report from the fragments saved with each answer.
+
+    Returns (name, city, total score, HTML), or None if nothing has been
+    answered. Sessions with answers saved before fragments existed are
+    rendered from the answers instead.
+    """
+    redis_client = Redis(connection_pool=pool)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hmget(
+            chat_id,
+            "cursor",
+            f"question_{roles['name']}",
+            f"question_{roles['location']}",
+        )
+        pipe.hgetall(report_key(chat_id))
+        (cursor, name, location), report = pipe.execute()
+
+        report = {k.decode("utf-8"): v.decode("utf-8") for k, v in report.items()}
+        answered = min(int(cursor), len(questions)) if cursor is not None else None
+        if answered is not None and all(
+            f"fragment_{i}" in report for i in range(answered)
+        ):
+            fragments = [report[f"fragment_{i}"] for i in range(answered)]
+            total_score = int(report.get("total", 0))
+        else:
+            session = redis_client.hgetall(chat_id)
+            answers = [
+                (i, json.loads(session[f"question_{i}".encode("utf-8")]))
+                for i in range(len(questions))
+                if f"question_{i}".encode("utf-8") in session
+            ]
+            fragments = [render_fragment(i, answer) for i, answer in answers]
+            total_score = sum(answer.get("score") or 0 for _, answer in answers)
+    finally:
+        redis_client.close()
+
+    if not fragments:
+        return None
+
+    name = json.loads(name).get("text", "N/A") if name else "Unknown"
+    city = json.loads(location).get("city") if location else "Unknown"
+    return name, city, total_score, "".join(fragments)
+
+
+def update_key(update_id):
+    return f"update:{update_id}"
+
+
+def claim_update(update_id):
+    """Return True the first time an update_id is seen within UPDATE_DEDUP_TTL."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        return bool(
+            redis_client.set(update_key(update_id), 1, nx=True, ex=UPDATE_DEDUP_TTL)
+        )
+    except Exception as e:
+        # Processing a rare duplicate beats dropping the update
+        logger.error(f"Error claiming update {update_id}: {e}")
+        return True
+    finally:
+        redis_client.close()
+
+
+def release_update(update_id):
+    """Forget a claimed update_id so Telegram's redelivery gets handled."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        redis_client.delete(update_key(update_id))
+    except Exception as e:
+        logger.error(f"Error releasing update {update_id}: {e}")
+    finally:
+        redis_client.close()
+
+
+def chat_lock_args(chat_id):
+    return {
+        "name": f"chat_lock:{chat_id}",
+        "timeout": CHAT_LOCK_TIMEOUT,
+        "blocking_timeout": CHAT_LOCK_WAIT,
+    }
+
+
+class ChatBusy(Exception):
+    """Another update held the chat's lock for all of CHAT_LOCK_WAIT."""
+
+    def __init__(self, chat_id):
+        super().__init__(f"Timed out waiting for the lock on chat {chat_id}")
+        self.chat_id = chat_id
+
+
+@contextlib.contextmanager
+def chat_lock(chat_id):
+    """Hold a per-chat Redis lock for the duration of a handler.
+
+    Updates for one chat are handled one at a time across all threads and
+    workers, while different chats still run in parallel. A thread renews
+    the lock every CHAT_LOCK_RENEW seconds until the handler returns.
+    Raises ChatBusy if the lock is not free within CHAT_LOCK_WAIT.
+    """
+    redis_client = Redis(connection_pool=pool)
+    # The renewing thread needs the lock's token too
+    lock = redis_client.lock(**chat_lock_args(chat_id), thread_local=False)
+    done = threading.Event()
+
+    def renew():
+        while not done.wait(CHAT_LOCK_RENEW):
+            try:
+                lock.extend(CHAT_LOCK_TIMEOUT, replace_ttl=True)
+            except Exception as e:
+                logger.error(f"Error renewing the lock on chat {chat_id}: {e}")
+                return
+
+    try:
+        if not lock.acquire():
+            raise ChatBusy(chat_id)
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            done.set()
+            renewer.join()
+            try:
+                lock.release()
+            except Exception as e:
+                logger.error(f"Error releasing the lock on chat {chat_id}: {e}")
+    finally:
+        redis_client.close()
+
+
+# Each cache namespace keeps its entries in "<namespace>:<key>" and a
+# sorted set "<namespace>:lru" of keys by last use. These helpers queue the
+# commands on a pipeline, which works the same for redis.asyncio.
+
+
+def queue_cache_touch(pipe, namespace, key):
+    pipe.zadd(f"{namespace}:lru", {key: time.time()})
+
+
+def queue_cache_write(pipe, namespace, key, value, ttl):
+    """Queue storing an entry; the pipeline's last result is the
+    namespace's size."""
+    pipe.set(f"{namespace}:{key}", value, ex=ttl)
+    queue_cache_touch(pipe, namespace, key)
+    pipe.zcard(f"{namespace}:lru")
+
+
+def cache_evicted_keys(namespace, evicted):
+    """The entry keys for members popped off the LRU index."""
+    return [f"{namespace}:{k.decode('utf-8')}" for k, _ in evicted]
+
+
+def cache_counter_key(namespace, hit):
+    return f"{namespace}:{'hits' if hit else 'misses'}"
+
+
+def cache_get(namespace, key):
+    """Return a cached string and refresh its position in the LRU index."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        value = redis_client.get(f"{namespace}:{key}")
+        if value is None:
+            return None
+
+        pipe = redis_client.pipeline(transaction=False)
+        queue_cache_touch(pipe, namespace, key)
+        pipe.execute()
+        return value.decode("utf-8")
+    except Exception as e:
+        logger.error(f"Error reading {namespace}: {e}")
+        return None
+    finally:
+        redis_client.close()
+
+
+def cache_set(namespace, key, value, ttl, max_entries):
+    """Store a string with a TTL, evicting the least recently used entries
+    once the namespace holds more than max_entries."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        pipe = redis_client.pipeline()
+        queue_cache_write(pipe, namespace, key, value, ttl)
+        size = pipe.execute()[-1]
+
+        if size > max_entries:
+            evicted = redis_client.zpopmin(f"{namespace}:lru", size - max_entries)
+            if evicted:
+                redis_client.delete(*cache_evicted_keys(namespace, evicted))
+    except Exception as e:
+        logger.error(f"Error writing {namespace}: {e}")
+    finally:
+        redis_client.close()
+
+
+def cache_record(namespace, hit):
+    """Count a cache hit or miss for the namespace."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        redis_client.incr(cache_counter_key(namespace, hit))
+    except Exception as e:
+        logger.error(f"Error counting {namespace}: {e}")
+    finally:
+        redis_client.close()
+
+
+METRIC_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Metrics live in Redis so that every gunicorn and Celery process adds to
+# the same series and /metrics can report them from any web worker.
+metrics = {
+    "stage_duration_seconds": ("histogram", "Time spent in each processing stage"),
+    "task_duration_seconds": ("histogram", "Celery task runtime"),
+    "stage_failures_total": ("counter", "Failures per stage and exception type"),
+    "answers_saved_total": ("counter", "Answers stored per question"),
+    "audio_files_total": ("counter", "Audio answers by upload path"),
+}
+
+
+def metric_labels(labels):
+    return ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+
+def queue_observation(pipe, name, seconds, labels):
+    """Queue the histogram updates for one observation on a pipeline."""
+    label_str = metric_labels(labels)
+    bucket = next((b for b in METRIC_BUCKETS if seconds <= b), "+Inf")
+    pipe.hincrby(f"metrics:{name}", f"{label_str}|{bucket}", 1)
+    pipe.hincrby(f"metrics:{name}", f"{label_str}|count", 1)
+    pipe.hincrbyfloat(f"metrics:{name}", f"{label_str}|sum", seconds)
+
+
+def failure_labels(stage, error):
+    return {"stage": stage, "error": type(error).__name__}
+
+
+def observe(name, seconds, **labels):
+    """Add one observation to a histogram."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        queue_observation(pipe, name, seconds, labels)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error recording {name}: {e}")
+    finally:
+        redis_client.close()
+
+
+def increment(name, amount=1, **labels):
+    """Add to a counter."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        redis_client.hincrby(f"metrics:{name}", metric_labels(labels), amount)
+    except Exception as e:
+        logger.error(f"Error recording {name}: {e}")
+    finally:
+        redis_client.close()
+
+
+def record_failure(stage, error):
+    increment("stage_failures_total", **failure_labels(stage, error))
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Time a block as a stage, counting it as failed if it raises."""
+    started = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        record_failure(stage, e)
+        raise
+    finally:
+        observe("stage_duration_seconds", time.monotonic() - started, stage=stage)
+
+
+_task_started = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def stop_task_timer(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        observe(
+            "task_duration_seconds",
+            time.monotonic() - started,
+            task=task.name,
+            state=state,
+        )
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format."""
+    queues = (IO_QUEUE, TRANSCODE_QUEUE, EMAIL_QUEUE)
+    redis_client = Redis(connection_pool=pool)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for name in metrics:
+            pipe.hgetall(f"metrics:{name}")
+        for queue in queues:
+            pipe.llen(queue)
+        for namespace in ("transcription_cache", "score_cache"):
+            pipe.get(f"{namespace}:hits")
+            pipe.get(f"{namespace}:misses")
+        results = pipe.execute()
+    finally:
+        redis_client.close()
+
+    lines = []
+    for name, values in zip(metrics, results):
+        kind, help_text = metrics[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        values = {k.decode("utf-8"): v.decode("utf-8") for k, v in values.items()}
+
+        if kind == "counter":
+            for label_str, value in sorted(values.items()):
+                lines.append(f"{name}{{{label_str}}} {value}")
+            continue
+
+        series = {}
+        for field, value in values.items():
+            label_str, _, part = field.rpartition("|")
+            series.setdefault(label_str, {})[part] = value
+
+        for label_str, parts in sorted(series.items()):
+            prefix = f"{label_str}," if label_str else ""
+            cumulative = 0
+            for bucket in METRIC_BUCKETS:
+                cumulative += int(parts.get(str(bucket), 0))
+                lines.append(f'{name}_bucket{{{prefix}le="{bucket}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {parts.get("count", 0)}')
+            lines.append(f"{name}_sum{{{label_str}}} {parts.get('sum', 0)}")
+            lines.append(f"{name}_count{{{label_str}}} {parts.get('count', 0)}")
+
+    queue_depths = results[len(metrics):len(metrics) + len(queues)]
+    lines.append("# HELP celery_queue_depth Tasks waiting in each Celery queue")
+    lines.append("# TYPE celery_queue_depth gauge")
+    for queue, depth in zip(queues, queue_depths):
+        lines.append(f'celery_queue_depth{{queue="{queue}"}} {depth}')
+
+    cache_counts = results[len(metrics) + len(queues):]
+    lines.append("# HELP cache_lookups_total Cache lookups by result")
+    lines.append("# TYPE cache_lookups_total counter")
+    for i, namespace in enumerate(("transcription_cache", "score_cache")):
+        hits, misses = cache_counts[2 * i], cache_counts[2 * i + 1]
+        lines.append(f'cache_lookups_total{{cache="{namespace}",result="hit"}} {int(hits or 0)}')
+        lines.append(f'cache_lookups_total{{cache="{namespace}",result="miss"}} {int(misses or 0)}')
+
+    return "\n".join(lines) + "\n"
+
+
+def get_keyboard(question_number):
+    """The serialized reply markup for a question, or the submit button."""
+    return steps[min(question_number, len(questions))]["markup"]
+
+
+async def send_question(io, chat_id, question_number):
+    """Send a question, or the submit prompt once every question is answered."""
+    step = steps[min(question_number, len(questions))]
+    await io.send_message(
+        chat_id, step["text"], parse_mode=step["parse_mode"], reply_markup=step["markup"]
+    )
+
+
+# Takes a token from the bot-wide and the per-chat bucket together, or
+# returns how many milliseconds to wait before trying again. ARGV is the
+# global rate and burst, then the chat's, with rates per millisecond.
+acquire_telegram_script = Redis(connection_pool=pool).register_script(
+    """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+
+local function refill(key, rate, burst)
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    return math.min(burst, tokens + (now - ts) * rate)
+end
+
+local global = refill(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]))
+local chat = refill(KEYS[2], tonumber(ARGV[3]), tonumber(ARGV[4]))
+local wait = 0
+if global < 1 then
+    wait = math.ceil((1 - global) / tonumber(ARGV[1]))
+end
+if chat < 1 then
+    wait = math.max(wait, math.ceil((1 - chat) / tonumber(ARGV[3])))
+end
+if wait > 0 then
+    return wait
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(global - 1), 'ts', now)
+redis.call('HSET', KEYS[2], 'tokens', tostring(chat - 1), 'ts', now)
+redis.call('PEXPIRE', KEYS[2], math.ceil(tonumber(ARGV[4]) / tonumber(ARGV[3])))
+return 0
+"""
+)
+
+
+def telegram_slot_args(chat_id):
+    """The keys and args for acquire_telegram_script."""
+    return {
+        "keys": ["telegram_limiter:global", f"telegram_limiter:chat:{chat_id}"],
+        "args": [
+            TELEGRAM_GLOBAL_RATE / 1000,
+            TELEGRAM_GLOBAL_RATE,
+            TELEGRAM_CHAT_RATE / 1000,
+            TELEGRAM_CHAT_BURST,
+        ],
+    }
+
+
+def telegram_send_args(chat_id, message):
+    """The send_message arguments for a message, for TeleBot or AsyncTeleBot."""
+    reply_to = message.get("reply_to")
+    return {
+        "chat_id": chat_id,
+        "text": message["text"],
+        "parse_mode": message.get("parse_mode"),
+        "reply_markup": message.get("reply_markup"),
+        "reply_parameters": types.ReplyParameters(reply_to) if reply_to else None,
+    }
+
+
+def telegram_retry_after(chat_id, error, attempt):
+    """Seconds to wait before resending after a Bot API error, or None to
+    give up: only 429s are retried, up to TELEGRAM_MAX_ATTEMPTS."""
+    if error.error_code != 429 or attempt == TELEGRAM_MAX_ATTEMPTS - 1:
+        return None
+    retry_after = (error.result_json.get("parameters") or {}).get("retry_after", 1)
+    logger.error(f"Telegram rate limited chat {chat_id}, retrying in {retry_after}s")
+    return retry_after
+
+
+def acquire_telegram_slot(redis_client, chat_id):
+    """Wait until both the bot-wide and the chat's send limits allow a message."""
+    while True:
+        wait_ms = acquire_telegram_script(
+            **telegram_slot_args(chat_id), client=redis_client
+        )
+        if wait_ms == 0:
+            return
+        time.sleep(wait_ms / 1000)
+
+
+def deliver_message(redis_client, chat_id, message):
+    """Send one message under the rate limits, retrying 429s after retry_after."""
+    for attempt in range(TELEGRAM_MAX_ATTEMPTS):
+        acquire_telegram_slot(redis_client, chat_id)
+        try:
+            with timed("telegram_send"):
+                return bot.send_message(**telegram_send_args(chat_id, message))
+        except apihelper.ApiTelegramException as e:
+            retry_after = telegram_retry_after(chat_id, e, attempt)
+            if retry_after is None:
+                raise
+            time.sleep(retry_after)
+
+
+def merge_messages(messages):
+    """Join consecutive texts into one message where Telegram would show
+    them the same way: same parse mode, and no keyboard or reply except
+    on the last of them."""
+    merged = []
+    for message in messages:
+        previous = merged[-1] if merged else None
+        if (
+            previous is not None
+            and not previous.get("reply_markup")
+            and not previous.get("reply_to")
+            and not message.get("reply_to")
+            and previous.get("parse_mode") == message.get("parse_mode")
+            and len(previous["text"]) + len(message["text"]) + 2
+            <= TELEGRAM_MAX_MESSAGE_LENGTH
+        ):
+            merged[-1] = {**message, "text": f"{previous['text']}\n\n{message['text']}"}
+        else:
+            merged.append(message)
+    return merged
+
+
+def outgoing_message(text, parse_mode=None, reply_markup=None, reply_to=None):
+    """The message send_message delivers or queues, as stored in an outbox.
+
+    reply_markup may be a markup object or its serialized JSON, and
+    reply_to a message id to reply to.
+    """
+    if isinstance(reply_markup, types.JsonSerializable):
+        reply_markup = reply_markup.to_json()
+    return {
+        "text": text,
+        "parse_mode": parse_mode,
+        "reply_markup": reply_markup,
+        "reply_to": reply_to,
+    }
+
+
+def queue_outbox_message(pipe, chat_id, message):
+    """Queue appending a message to the chat's outbox on a pipeline; the
+    last result is true if no deliver_messages task is scheduled yet."""
+    # The scheduled flag lets one deliver_messages task own the outbox at a
+    # time, which keeps the chat's messages in order.
+    pipe.rpush(f"outbox:{chat_id}", json.dumps(message))
+    pipe.set(f"outbox:{chat_id}:scheduled", 1, nx=True, ex=OUTBOX_DRAIN_TIMEOUT)
+
+
+def send_message(chat_id, text, parse_mode=None, reply_markup=None, reply_to=None):
+    """Send a message to a chat, or queue it in TELEGRAM_SEND_MODE=queue."""
+    message = outgoing_message(text, parse_mode, reply_markup, reply_to)
+
+    redis_client = Redis(connection_pool=pool)
+    try:
+        if TELEGRAM_SEND_MODE != "queue":
+            deliver_message(redis_client, chat_id, message)
+            return
+
+        pipe = redis_client.pipeline()
+        queue_outbox_message(pipe, chat_id, message)
+        scheduled = pipe.execute()[-1]
+    finally:
+        redis_client.close()
+
+    if scheduled:
+        from tasks import deliver_messages  # tasks imports this module
+
+        deliver_messages.delay(chat_id)
+
+
+def drain_outbox(chat_id):
+    """Send everything queued for a chat, in order, until the outbox is empty."""
+    key = f"outbox:{chat_id}"
+    redis_client = Redis(connection_pool=pool)
+    try:
+        while True:
+            pipe = redis_client.pipeline()
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            messages, _ = pipe.execute()
+
+            if not messages:
+                redis_client.delete(f"{key}:scheduled")
+                # A message queued just before the flag was cleared found it
+                # still set and scheduled nothing, so pick it up here
+                if redis_client.llen(key) and redis_client.set(
+                    f"{key}:scheduled", 1, nx=True, ex=OUTBOX_DRAIN_TIMEOUT
+                ):
+                    continue
+                return
+
+            for message in merge_messages([json.loads(m) for m in messages]):
+                try:
+                    deliver_message(redis_client, chat_id, message)
+                except Exception as e:
+                    logger.error(f"Error sending message to {chat_id}: {e}")
+    finally:
+        redis_client.close()
+
+
+def run_sync(coroutine):
+    """Run a handler coroutine to completion on the calling thread.
+
+    Every await on SyncIO finishes without suspending, so the coroutine
+    completes on its first step and needs no event loop.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    coroutine.close()
+    raise RuntimeError("A handler suspended while running on SyncIO")
+
+
+class SyncIO:
+    """The I/O the shared handlers use in the Flask web process and the
+    Celery workers: the blocking functions above, behind the same
+    awaitable interface as async_main.AsyncIO."""
+
+    async def get_current_question(self, chat_id):
+        return get_current_question(chat_id)
+
+    async def save_answer(self, chat_id, question_number, answer):
+        return save_answer(chat_id, question_number, answer)
+
+    async def rewind_question(self, chat_id):
+        return rewind_question(chat_id)
+
+    async def clear_responses(self, chat_id):
+        clear_responses(chat_id)
+
+    async def get_score(self, question, transcription):
+        return get_score(question, transcription)
+
+    async def send_message(
+        self, chat_id, text, parse_mode=None, reply_markup=None, reply_to=None
+    ):
+        send_message(chat_id, text, parse_mode, reply_markup, reply_to)
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        bot.answer_callback_query(callback_query_id, text)
+
+    async def get_file(self, file_id):
+        with timed("telegram_get_file"):
+            return bot.get_file(file_id)
+
+    @contextlib.asynccontextmanager
+    async def chat_lock(self, chat_id):
+        with chat_lock(chat_id):
+            yield
+
+    async def blocking(self, func, *args):
+        """Run a blocking call, such as queueing a task or the rarely used
+        submit path, that has no async counterpart."""
+        return func(*args)
+
+
+sync_io = SyncIO()
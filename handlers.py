@@ -0,0 +1,250 @@
+"""Telegram bot handlers, shared by the sync and async runtimes.
+
+Each handler is a coroutine that does its I/O through io: common.SyncIO
+under Flask and Celery, async_main.AsyncIO on the event loop.
+register_handlers attaches them to either kind of bot.
+"""
+import datetime
+import uuid
+
+from common import (
+    AUDIO_ANSWER_MODE,
+    SCORING_MODE,
+    bot,
+    choices,
+    get_keyboard,
+    get_report,
+    logger,
+    max_score,
+    questions,
+    run_sync,
+    send_question,
+    steps,
+    sync_io,
+)
+from tasks import (
+    archive_session,
+    deliver_email,
+    email_queue_depth,
+    hold_submit,
+    process_audio,
+    process_pending_audio,
+    record_answer,
+    score_pending,
+)
+
+
+async def start(io, message):
+    """Handle /start and /restart commands."""
+    chat_id = message.chat.id
+    await io.clear_responses(chat_id)
+
+    message_to_send = "Welcome!\nI will send you questions for you to answer and your answers will then be sent to the appropriate team members!\nHold down the microphone to answer."
+    await io.send_message(chat_id, message_to_send, parse_mode="Markdown")
+    await io.send_message(chat_id, questions[0], parse_mode="Markdown")
+
+
+
+async def send_email(io, chat_id, wait_for_pending=True):
+    """Queue the candidate's report, joined from the saved fragments.
+
+    While voice answers are still pending the report is held back, and the
+    worker that fills in the last of them submits it.
+    """
+    if wait_for_pending and AUDIO_ANSWER_MODE == "optimistic":
+        if await io.blocking(hold_submit, chat_id):
+            await io.send_message(
+                chat_id,
+                "We are still processing your recordings. Your details will be submitted as soon as they are done.",
+            )
+            return
+
+    if SCORING_MODE != "per_answer":
+        await io.blocking(score_pending, chat_id)
+
+    report = await io.blocking(get_report, chat_id)
+    if report is None:
+        await io.send_message(chat_id, "No data recorded yet.")
+        return
+
+    name, city, total_score, message = report
+    output = f"<h2>Total Score: {total_score}/{max_score}</h2><br><h3>Recorded Data:</h3><br>{message}"
+    timestamp = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+
+    if city:
+        subject = f"{name}-{city} ({timestamp})"
+    else:
+        subject = f"{name} ({timestamp})"
+
+    await io.blocking(deliver_email.delay, subject, output)
+    await io.blocking(archive_session.delay, chat_id)
+    depth = await io.blocking(email_queue_depth)
+    logger.info(f"Queued report for {chat_id}, email queue depth {depth}")
+
+    await io.send_message(chat_id, "Details submitted successfully.")
+
+
+
+async def restart(io, call):
+    await io.clear_responses(call.message.chat.id)
+    await start(io, call.message)
+
+
+async def answer_last_question_again(io, call):
+    chat_id = call.message.chat.id
+    last_question_index = await io.rewind_question(chat_id)
+    if last_question_index is not None:
+        await send_question(io, chat_id, last_question_index)
+    else:
+        await io.send_message(
+            chat_id,
+            "There is no previous question to answer.",
+            reply_markup=get_keyboard(0),
+        )
+
+
+async def submit(io, call):
+    await send_email(io, call.message.chat.id)
+
+
+callback_actions = {
+    "restart": restart,
+    "last_question": answer_last_question_again,
+    "send_email": submit,
+}
+
+
+async def handle_callback(io, call):
+    chat_id = call.message.chat.id
+    action = callback_actions.get(call.data)
+    choice = choices.get(call.data)
+
+    async with io.chat_lock(chat_id):
+        if action is not None:
+            await action(io, call)
+        elif choice is not None:
+            response = {
+                "text": choice["text"],
+                "score": choice["score"],
+            }
+            next_question = await io.save_answer(chat_id, choice["question"], response)
+            if next_question is not None:
+                await send_question(io, chat_id, next_question)
+        else:
+            await io.answer_callback_query(call.id, "Invalid option")
+
+        await io.answer_callback_query(call.id)
+
+
+async def ask_for_button(io, message, step):
+    """Button questions take no typed or spoken answer."""
+    chat_id = message.chat.id
+    await io.send_message(
+        chat_id,
+        "Please use the buttons to answer the question",
+        parse_mode="Markdown",
+    )
+    await send_question(io, chat_id, step["number"])
+
+
+async def accept_answer(io, message, step):
+    """Score a text answer now, or queue a voice answer for transcription."""
+    chat_id = message.chat.id
+
+    if message.content_type == "text":
+        await record_answer(io, chat_id, step["number"], message.text)
+
+    elif message.content_type in ["audio", "voice"] or (
+        message.content_type == "document"
+        and (message.document.mime_type or "").startswith("audio/")
+    ):
+        audio_file = message.audio or message.voice or message.document
+        if AUDIO_ANSWER_MODE == "optimistic":
+            await accept_pending_audio(io, chat_id, step, audio_file)
+            return
+
+        file_info = await io.get_file(audio_file.file_id)
+        await io.send_message(
+            chat_id,
+            "Please wait while we process the audio",
+            reply_to=message.message_id,
+        )
+        await io.blocking(
+            process_audio.delay,
+            file_info.file_path,
+            chat_id,
+            step["number"],
+            audio_file.file_unique_id,
+            file_info.file_size or audio_file.file_size,
+            getattr(audio_file, "duration", None),
+        )
+
+
+async def accept_pending_audio(io, chat_id, step, audio_file):
+    """Store a voice answer as pending and move straight on to the next
+    question, leaving get_file, transcription and scoring to the worker."""
+    pending = uuid.uuid4().hex
+    next_question = await io.save_answer(chat_id, step["number"], {"pending": pending})
+    if next_question is None:
+        return
+
+    await io.blocking(
+        process_pending_audio.delay,
+        audio_file.file_id,
+        chat_id,
+        step["number"],
+        audio_file.file_unique_id,
+        audio_file.file_size,
+        getattr(audio_file, "duration", None),
+        pending,
+    )
+    await send_question(io, chat_id, next_question)
+
+
+# One handler per question, picked when the module loads
+question_handlers = [
+    ask_for_button if step["choices"] else accept_answer for step in steps[:-1]
+]
+
+
+async def handle_responses(io, message):
+    """Handle text and audio responses."""
+    chat_id = message.chat.id
+
+    async with io.chat_lock(chat_id):
+        current_question = await io.get_current_question(chat_id)
+
+        if current_question < len(questions):
+            step = steps[current_question]
+            if step["notice"]:
+                await io.send_message(chat_id, step["notice"], parse_mode="Markdown")
+
+            await question_handlers[current_question](io, message, step)
+        else:
+            await io.send_message(
+                chat_id,
+                "All questions have been answered. Thank you!",
+                # reply_markup=get_keyboard(current_question),
+            )
+
+
+def register_handlers(target, io, run=None):
+    """Attach the handlers to a TeleBot or AsyncTeleBot.
+
+    run turns a handler's coroutine into what the bot expects back: run_sync
+    for TeleBot, while AsyncTeleBot awaits the coroutine itself.
+    """
+
+    def bind(handler):
+        if run is None:
+            return lambda update: handler(io, update)
+        return lambda update: run(handler(io, update))
+
+    target.register_message_handler(bind(start), commands=["start", "restart"])
+    target.register_callback_query_handler(bind(handle_callback), func=lambda call: True)
+    target.register_message_handler(
+        bind(handle_responses), content_types=["document", "audio", "voice", "text"]
+    )
+
+
+register_handlers(bot, sync_io, run_sync)
@@ -0,0 +1,138 @@
+"""Report Redis memory use per key class.
+
+Usage: python memory_report.py [--samples 5] [--expire-legacy]
+
+Every key is visited with SCAN and sized with MEMORY USAGE in pipelined
+batches, then grouped by what it holds: sessions, report fragments, the
+caches, Celery queues and results, and so on. Keys without an expiry are
+counted separately, since those are what grows without bound.
+--expire-legacy gives sessions saved before SESSION_TTL existed that TTL.
+"""
+import argparse
+import re
+import time
+
+from redis import Redis
+
+from common import (
+    EMAIL_QUEUE,
+    IO_QUEUE,
+    SESSION_TTL,
+    TRANSCODE_QUEUE,
+    pool,
+)
+
+CHAT_KEY = re.compile(rb"-?\d+")
+BATCH_SIZE = 500
+
+# Checked in order, so longer prefixes come before shorter ones they start with
+KEY_PREFIXES = (
+    (b"report:", "reports"),
+    (b"outbox:", "outboxes"),
+    (b"chat_lock:", "chat locks"),
+    (b"update:", "update dedup"),
+    (b"audio_part:", "audio parts"),
+    (b"score_cache:", "score cache"),
+    (b"transcription_cache:", "transcription cache"),
+    (b"metrics:", "metrics"),
+    (b"openai_limiter:", "openai limiter"),
+    (b"telegram_limiter:", "telegram limiter"),
+    (b"celery-task-meta-", "celery results"),
+    (b"_kombu.binding.", "celery bindings"),
+    (b"unacked", "celery unacked"),
+)
+QUEUES = tuple(q.encode("utf-8") for q in (IO_QUEUE, TRANSCODE_QUEUE, EMAIL_QUEUE))
+
+
+def classify(key):
+    if CHAT_KEY.fullmatch(key):
+        return "sessions"
+    for prefix, name in KEY_PREFIXES:
+        if key.startswith(prefix):
+            return name
+    # Priority queues are named <queue>\x06\x16<priority>
+    if any(key == q or key.startswith(q + b"\x06\x16") for q in QUEUES):
+        return "celery queues"
+    return "other"
+
+
+def batches(keys):
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=5,
+        help="nested values MEMORY USAGE samples per key (0 measures them all)",
+    )
+    parser.add_argument(
+        "--expire-legacy",
+        action="store_true",
+        help="give sessions and reports without an expiry SESSION_TTL",
+    )
+    args = parser.parse_args()
+
+    totals = {}
+    expired = 0
+    started = time.monotonic()
+
+    redis_client = Redis(connection_pool=pool)
+    try:
+        for batch in batches(redis_client.scan_iter(count=1000)):
+            pipe = redis_client.pipeline(transaction=False)
+            for key in batch:
+                pipe.memory_usage(key, samples=args.samples)
+                pipe.ttl(key)
+            results = pipe.execute()
+
+            legacy = []
+            for key, size, ttl in zip(batch, results[::2], results[1::2]):
+                # The key expired between SCAN and MEMORY USAGE
+                if size is None:
+                    continue
+
+                name = classify(key)
+                keys, used, persistent = totals.get(name, (0, 0, 0))
+                totals[name] = (keys + 1, used + size, persistent + (ttl == -1))
+                if ttl == -1 and name in ("sessions", "reports"):
+                    legacy.append(key)
+
+            if args.expire_legacy and legacy:
+                pipe = redis_client.pipeline(transaction=False)
+                for key in legacy:
+                    pipe.expire(key, SESSION_TTL)
+                expired += sum(pipe.execute())
+
+        used_memory = redis_client.info("memory").get("used_memory")
+    finally:
+        redis_client.close()
+
+    print(f"{'class':<22}{'keys':>10}{'bytes':>14}{'avg':>10}{'no expiry':>12}")
+    for name, (keys, used, persistent) in sorted(
+        totals.items(), key=lambda item: -item[1][1]
+    ):
+        print(f"{name:<22}{keys:>10}{used:>14}{used // keys:>10}{persistent:>12}")
+
+    keys = sum(t[0] for t in totals.values())
+    used = sum(t[1] for t in totals.values())
+    print(f"{'total':<22}{keys:>10}{used:>14}")
+    print(
+        f"\nScanned in {time.monotonic() - started:.1f}s; "
+        f"Redis reports {used_memory} bytes used in all"
+    )
+    if args.expire_legacy:
+        print(f"Set a {SESSION_TTL}s expiry on {expired} legacy session keys")
+
+
+if __name__ == "__main__":
+    main()
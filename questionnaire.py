@@ -0,0 +1,79 @@
+"""The interview, declared as data.
+
+Each entry is one question, asked in order:
+
+- text: the question as sent to the candidate
+- role: "name" or "location" for the answers the report subject uses
+- notice: a message sent before handling the answer
+- choices: buttons to answer with instead of free text, each with its
+  label, callback data and score
+- rubric: the points breakdown the LLM scores a free-text answer by
+
+common.compile_questionnaire turns this into the lookup table the bot
+runs from, so changing the interview means editing only this file.
+"""
+
+rubric_template = (
+    "You are a point-scoring bot that strictly replies with 0, 5 or 10, \n"
+    "Here is the question:\n{question} \n\n"
+    "Follow the points breakdown below for scoring: \n{rubric}"
+)
+rubric_scores = (0, 5, 10)
+
+submit_prompt = "Thank you! All your responses have been recorded. Would you like to submit your application?"
+
+questionnaire = [
+    {
+        "text": "What is your name?",
+        "role": "name",
+    },
+    {
+        "text": "What is your state, city, and zip code?",
+        "role": "location",
+    },
+    {
+        "text": "What is your preferred contact number?",
+        "notice": "I will ask you a few questions and score your answers based on information provided by the team. Your answers and overall score will then be passed on to the team for follow up  at your preferred number or email address.  We use this method for fairness and everyone  is asked the same questions.  If your answers are within a certain score the team will  contact you.  You may also follow up at  hello@melospeech.com  . Any questions you have  can be added at the end of the process and will be forwarded to the team for follow up.",
+    },
+    {
+        "text": "How many years of experience in the field of communication sciences (SLP/SLPA) do you have?",
+        "choices": [
+            {"label": "1+ years", "data": "1+ years", "score": 10},
+            {"label": "Less than 1 year", "data": "Less than 1 year", "score": 0},
+        ],
+    },
+    {
+        "text": "In what settings have you worked?",
+    },
+    {
+        "text": "Do you have experience with infants and toddlers under 3?",
+        "choices": [
+            {"label": "Yes", "data": "5_Yes", "score": 10},
+            {"label": "No", "data": "5_No", "score": 0},
+        ],
+    },
+    {
+        "text": "If you know any other languages, please share them.",
+    },
+    {
+        "text": "It is your first session with a little 2 year old.  You have done a full case review and you  see that he is not speaking but appears to understand.  Parents are VERY concerned.  They do not know you and have never met you before.  What is this first session in the  home looking like?  What do you do?",
+        "rubric": "-Award 10 points for this best Answer:  Building  Rapport  - any mention of building rapport such as  playing with the child,  following child's lead in play/child-led play  , gaining trust, asking parents  about their concerns, addressing parent concerns, explaining what to expect, etc.  The key word  is rapport with how they plan to do that. \n=Award 5 Points for this  Acceptable Answer: Play (but no mention of child-led or following child's  lead)  \n-Award 0 points Not acceptable:  Target goals right away.  Have parents wait outside. Anything  that is not building rapport or gaining trust.",
+    },
+    {
+        "text": "This little one is not speaking.  Just pretend that you knew that he would only ever speak 5  words his whole life (we can't know this, but pretend) - and these 5 words were taught by  you at the age of 2.  What 5 words would you wish that you could teach him?",
+        "rubric": "-Award 10 Points for this Best Answer:  Any list of 5  core/functional words  (e.g., help, want,  more, done/all done, yes, no, eat, drink, hurt, again, etc.)  \n-Award 5 Points for this Acceptable Answers:  mom/dad/caregiver's name  \n-Award 0 Points - Not Acceptable: colors, shapes, numbers, any word that is NOT functional and  would not allow for generalization to other tasks.  phone number, SSN - too old for a little child  who is 2-years-old to learn especially if they have no other words that they speak yet.",
+    },
+    {
+        "text": "This family knows and loves you now, but suppose they have an illness in the home - we  don't want you to go to a home if they are sick - and we will offer a virtual session.   How  are you keeping this little one engaged for a virtual 60 minute session?",
+        "rubric": "-Award 10 points for this Best Answer:  Any mention of the following:   Parent Coaching,  using  materials/toys in their home, letting parents know how to use the toys in the home to facilitate  language during play, communication temptations, songs on youtube, allowing the child to run  around and learn in the home, using actual toys that I have in my home, etc. -  must mention  family is actively involved in the session \n-Award 5 points for this Acceptable answers: occasional computer games, boom cards, ultimate  SLP, etc.  \n-Award 0 points for this Unacceptable answer(s):  Strapping the child into a high chair, parents  waiting in another room, no mention of parent coaching or the parents, lost look or I don't know.",
+    },
+    {
+        "text": "What is your current availability?",
+    },
+    {
+        "text": "What is your hourly pay rate?",
+    },
+    {
+        "text": "Do you have any questions for me? I will forward them to our team and get back to you after we  review your responses internally if the parameters are met.",
+    },
+]
@@ -0,0 +1,240 @@
+"""Re-score stored interviews after a rubric in `prompts` changes.
+
+Usage: python rescore.py [--concurrency 16] [--questions 7 8 9] [--force] [--dry-run]
+                         [--archive [--date 2026-01-31]]
+
+Chat hashes are found with SCAN, answers to the rubric questions are
+scored through get_score on a thread pool, and the new score is written
+back together with the rubric version it was produced under. Answers
+already scored under the current rubric are skipped unless --force is given,
+which also scores every answer afresh instead of reading the score cache.
+
+A submitted session only stays in Redis for SUBMITTED_SESSION_TTL, so
+--archive re-scores the archived interviews instead: the latest record of
+each chat is scored the same way and, if anything changed, appended to the
+archive again with its new scores and total. Run it where ARCHIVE_DIR is.
+"""
+import argparse
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import Redis
+
+from archive import append_record, find_records
+from common import (
+    OPENAI_MAX_CONNECTIONS,
+    get_score,
+    logger,
+    pool,
+    prompts,
+    rubric_versions,
+    update_answer,
+)
+
+CHAT_KEY = re.compile(rb"-?\d+")
+
+
+def scan_chats(redis_client):
+    """Yield the chat ids of every stored session without blocking Redis."""
+    for key in redis_client.scan_iter(count=1000, _type="hash"):
+        if CHAT_KEY.fullmatch(key):
+            yield int(key)
+
+
+def needs_score(question_number, response, force):
+    if not response.get("text"):
+        return False
+    return force or response.get("rubric_version") != rubric_versions[question_number]
+
+
+def pending_answers(redis_client, chat_id, question_numbers, force):
+    """Return (question, text) pairs in a session that need a new score."""
+    fields = [f"question_{q}" for q in question_numbers]
+    stored = redis_client.hmget(chat_id, fields)
+
+    pending = []
+    for question_number, value in zip(question_numbers, stored):
+        if value is None:
+            continue
+
+        response = json.loads(value)
+        if needs_score(question_number, response, force):
+            pending.append((question_number, response["text"]))
+
+    return pending
+
+
+def rescore_answer(chat_id, question_number, text, dry_run, force):
+    score = get_score(question_number, text, use_cache=not force)
+    if score is None:
+        return "failed"
+
+    if dry_run:
+        return "rescored"
+
+    fields = {"score": score, "rubric_version": rubric_versions[question_number]}
+    if update_answer(chat_id, question_number, text, fields):
+        return "rescored"
+
+    return "changed"
+
+
+def latest_records(date=None):
+    """The latest archived interview of each chat submitted on date (or any
+    day), which supersedes the earlier ones and any a previous run re-scored."""
+    records = {}
+    for record in find_records():
+        records[record["chat_id"]] = record
+    if date is not None:
+        chat_ids = {record["chat_id"] for record in find_records(date=date)}
+        return [records[chat_id] for chat_id in chat_ids]
+    return list(records.values())
+
+
+def rescore_record(record, question_numbers, force, dry_run):
+    """Re-score an archived interview and append the result to the archive.
+
+    Returns the counts of answers re-scored and failed.
+    """
+    answers = dict(record["answers"])
+    counts = {"rescored": 0, "failed": 0}
+    for question_number in question_numbers:
+        response = answers.get(str(question_number))
+        if response is None or not needs_score(question_number, response, force):
+            continue
+
+        score = get_score(question_number, response["text"], use_cache=not force)
+        if score is None:
+            counts["failed"] += 1
+            continue
+
+        answers[str(question_number)] = {
+            **response,
+            "score": score,
+            "rubric_version": rubric_versions[question_number],
+        }
+        counts["rescored"] += 1
+
+    if counts["rescored"] and not dry_run:
+        total_score = sum(answer.get("score") or 0 for answer in answers.values())
+        append_record(
+            record["chat_id"],
+            {**record, "answers": answers, "total_score": total_score, "rescored": True},
+        )
+    return counts
+
+
+def rescore_sessions(args, question_numbers, counts, started):
+    """Re-score the answers in every session still in Redis."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = []
+            for chat_id in scan_chats(redis_client):
+                counts["sessions"] += 1
+                for question_number, text in pending_answers(
+                    redis_client, chat_id, question_numbers, args.force
+                ):
+                    futures.append(
+                        executor.submit(
+                            rescore_answer,
+                            chat_id,
+                            question_number,
+                            text,
+                            args.dry_run,
+                            args.force,
+                        )
+                    )
+
+            for i, future in enumerate(futures, start=1):
+                try:
+                    counts[future.result()] += 1
+                except Exception as e:
+                    logger.error(f"Error re-scoring answer: {e}")
+                    counts["failed"] += 1
+
+                if i % 100 == 0:
+                    elapsed = time.monotonic() - started
+                    print(f"{i}/{len(futures)} answers, {i / elapsed:.1f} answers/s")
+    finally:
+        redis_client.close()
+
+
+def rescore_archive(args, question_numbers, counts):
+    """Re-score the latest archived interview of every chat."""
+    records = latest_records(args.date)
+    counts["sessions"] = len(records)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(
+                rescore_record, record, question_numbers, args.force, args.dry_run
+            )
+            for record in records
+        ]
+        for future in futures:
+            try:
+                for name, count in future.result().items():
+                    counts[name] += count
+            except Exception as e:
+                logger.error(f"Error re-scoring archived interview: {e}")
+                counts["failed"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=min(16, OPENAI_MAX_CONNECTIONS),
+        help="parallel scoring calls (keep at or below OPENAI_MAX_CONNECTIONS)",
+    )
+    parser.add_argument(
+        "--questions",
+        type=int,
+        nargs="+",
+        default=sorted(prompts),
+        help="rubric questions to re-score",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="re-score answers already scored under the current rubric, "
+        "bypassing the score cache",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="score answers but do not write the results back",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="re-score archived interviews instead of the sessions in Redis",
+    )
+    parser.add_argument("--date", help="with --archive, only this day, as YYYY-MM-DD (UTC)")
+    args = parser.parse_args()
+
+    question_numbers = [q for q in args.questions if q in prompts]
+    counts = {"sessions": 0, "rescored": 0, "failed": 0, "changed": 0}
+    started = time.monotonic()
+
+    if args.archive:
+        rescore_archive(args, question_numbers, counts)
+    else:
+        rescore_sessions(args, question_numbers, counts, started)
+
+    elapsed = time.monotonic() - started
+    answers = counts["rescored"] + counts["failed"] + counts["changed"]
+    scanned = "archived interviews" if args.archive else "sessions"
+    print(
+        f"Scanned {counts['sessions']} {scanned} in {elapsed:.1f}s: "
+        f"{counts['rescored']} re-scored, {counts['failed']} failed, "
+        f"{counts['changed']} changed while scoring "
+        f"({answers / elapsed if elapsed else 0:.1f} answers/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
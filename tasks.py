@@ -0,0 +1,1019 @@
+"""Celery tasks: audio processing, background LLM work and report delivery.
+
+ffmpeg, smtplib and the email package are imported inside the functions
+that use them, so the web process can import this module to enqueue
+tasks without loading them.
+"""
+import ast
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import Redis
+from telebot import types
+
+from archive import append_record
+from common import (
+    BOT_TOKEN,
+    CHAT_BUSY_NOTICE,
+    CHAT_LOCK_HOLD_MAX,
+    CHAT_LOCK_WAIT,
+    EMAIL_QUEUE,
+    SCORING_MODE,
+    SUBMITTED_SESSION_TTL,
+    TELEGRAM_API_URL,
+    ChatBusy,
+    batch_score,
+    bot,
+    cache_get,
+    cache_record,
+    cache_set,
+    call_openai,
+    celery,
+    defer_submit,
+    drain_outbox,
+    get_cached_score,
+    get_city,
+    get_keyboard,
+    get_openai_client,
+    get_score,
+    increment,
+    logger,
+    pool,
+    prompts,
+    report_key,
+    roles,
+    rubric_versions,
+    run_sync,
+    resolve_pending,
+    score_cache_key,
+    send_message,
+    send_question,
+    sync_io,
+    telegram_session,
+    timed,
+    update_answer,
+)
+
+AUDIO_SPOOL_MAX_SIZE = int(os.environ.get("AUDIO_SPOOL_MAX_SIZE", 8 * 1024 * 1024))
+AUDIO_CHUNK_SIZE = 64 * 1024
+AUDIO_DOWNLOAD_TIMEOUT = float(os.environ.get("AUDIO_DOWNLOAD_TIMEOUT", 30))
+# Files up to this size in a format Whisper reads are uploaded untouched;
+# larger ones are transcoded to 16 kHz Opus first.
+AUDIO_PASSTHROUGH_MAX_SIZE = int(
+    os.environ.get("AUDIO_PASSTHROUGH_MAX_SIZE", 2 * 1024 * 1024)
+)
+# File extensions the transcription endpoint accepts
+WHISPER_FORMATS = {
+    "flac", "m4a", "mp3", "mp4", "mpeg", "mpga", "oga", "ogg", "wav", "webm"
+}
+# MP4-family containers may keep their index (the moov atom) after the
+# audio, so ffmpeg has to seek in them and cannot read them from a pipe
+SEEKABLE_FORMATS = {"3g2", "3gp", "m4a", "m4b", "mov", "mp4"}
+
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", 30))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "true").lower() == "true"
+EMAIL_MAX_RETRIES = int(os.environ.get("EMAIL_MAX_RETRIES", 8))
+EMAIL_RETRY_BACKOFF = int(os.environ.get("EMAIL_RETRY_BACKOFF", 10))
+# Recordings longer than this are split at pauses into chunks no longer
+# than it, which are transcribed in parallel
+TRANSCRIPTION_CHUNK_SECONDS = float(os.environ.get("TRANSCRIPTION_CHUNK_SECONDS", 60))
+TRANSCRIPTION_CHUNK_CONCURRENCY = int(
+    os.environ.get("TRANSCRIPTION_CHUNK_CONCURRENCY", 4)
+)
+SILENCE_NOISE = "-35dB"
+SILENCE_MIN_DURATION = 0.3
+SILENCE_PATTERN = re.compile(r"silence_(start|end): (-?[\d.]+)")
+PROGRESS_PATTERN = re.compile(r"time=(\d+):(\d+):([\d.]+)")
+# How long prepared audio waits in Redis for the IO queue to pick it up
+AUDIO_PART_TTL = int(os.environ.get("AUDIO_PART_TTL", 3600))
+TRANSCRIPTION_CACHE_TTL = int(os.environ.get("TRANSCRIPTION_CACHE_TTL", 30 * 24 * 3600))
+TRANSCRIPTION_CACHE_MAX_ENTRIES = int(
+    os.environ.get("TRANSCRIPTION_CACHE_MAX_ENTRIES", 10000)
+)
+# A queued update whose chat is busy is retried this often, until the
+# handler holding the lock must have finished
+CHAT_BUSY_RETRY_DELAY = int(os.environ.get("CHAT_BUSY_RETRY_DELAY", 5))
+CHAT_BUSY_MAX_RETRIES = math.ceil(
+    CHAT_LOCK_HOLD_MAX / (CHAT_LOCK_WAIT + CHAT_BUSY_RETRY_DELAY)
+)
+# A submit held for pending voice answers goes ahead without them after this
+PENDING_SUBMIT_TIMEOUT = int(os.environ.get("PENDING_SUBMIT_TIMEOUT", 300))
+
+
+_smtp_connection = None
+_smtp_connection_pid = None
+_smtp_connection_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_recipients():
+    """The TO_EMAIL list, parsed on first use rather than at import."""
+    return ast.literal_eval(os.environ.get("TO_EMAIL"))
+
+
+def get_smtp_connection():
+    """Return this worker's SMTP connection, reconnecting if it went stale."""
+    global _smtp_connection, _smtp_connection_pid
+
+    import smtplib
+
+    if _smtp_connection is not None and _smtp_connection_pid == os.getpid():
+        try:
+            if _smtp_connection.noop()[0] == 250:
+                return _smtp_connection
+        except smtplib.SMTPException:
+            pass
+        close_smtp_connection()
+
+    server = smtplib.SMTP(
+        os.environ.get("SMTP_SERVER"),
+        int(os.environ.get("SMTP_PORT")),
+        timeout=SMTP_TIMEOUT,
+    )
+    if SMTP_STARTTLS:
+        server.starttls()
+    server.login(os.environ.get("SMTP_LOGIN"), os.environ.get("SMTP_PASSWORD"))
+    _smtp_connection = server
+    _smtp_connection_pid = os.getpid()
+    return server
+
+
+def close_smtp_connection():
+    global _smtp_connection
+
+    import smtplib
+
+    if _smtp_connection is not None and _smtp_connection_pid == os.getpid():
+        try:
+            _smtp_connection.quit()
+        except smtplib.SMTPException:
+            pass
+        except OSError:
+            pass
+    _smtp_connection = None
+
+
+def email_queue_depth():
+    """Number of reports waiting in the broker for delivery."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        return redis_client.llen(EMAIL_QUEUE)
+    except Exception as e:
+        logger.error(f"Error reading email queue depth: {e}")
+        return None
+    finally:
+        redis_client.close()
+
+
+@celery.task(bind=True, max_retries=EMAIL_MAX_RETRIES)
+def deliver_email(self, subject, html):
+    """Send a report to every recipient over the worker's SMTP connection."""
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    from_email = os.environ.get("FROM_EMAIL")
+    to_emails = get_recipients()
+
+    msg = MIMEMultipart()
+    msg['From'] = f"QueryPro Bot <{from_email}>"
+    msg['To'] = ", ".join(to_emails)
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html, 'html'))
+
+    try:
+        with _smtp_connection_lock, timed("smtp"):
+            server = get_smtp_connection()
+            server.sendmail(from_email, to_emails, msg.as_string())
+        print("Email sent successfully")
+    except (smtplib.SMTPException, OSError) as e:
+        print("Error sending email:", e)
+        with _smtp_connection_lock:
+            close_smtp_connection()
+        raise self.retry(
+            exc=e, countdown=min(EMAIL_RETRY_BACKOFF * 2 ** self.request.retries, 600)
+        )
+
+
+@celery.task
+def archive_session(chat_id):
+    """Archive a submitted interview, then let its session expire."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(chat_id)
+        pipe.hget(report_key(chat_id), "total")
+        session, total = pipe.execute()
+        if not session:
+            return
+
+        session = {k.decode("utf-8"): v.decode("utf-8") for k, v in session.items()}
+        answers = {
+            field[len("question_"):]: json.loads(value)
+            for field, value in session.items()
+            if field.startswith("question_")
+        }
+        append_record(
+            chat_id,
+            {
+                "chat_id": chat_id,
+                "answers": answers,
+                "total_score": int(total) if total is not None else None,
+            },
+        )
+
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.expire(chat_id, SUBMITTED_SESSION_TTL)
+        pipe.expire(report_key(chat_id), SUBMITTED_SESSION_TTL)
+        pipe.execute()
+    finally:
+        redis_client.close()
+
+
+@celery.task(bind=True, max_retries=CHAT_BUSY_MAX_RETRIES)
+def process_update(self, payload):
+    """Run the bot handlers for an update queued by the webhook.
+
+    An update whose chat is still locked by another one is retried later
+    rather than handled without the lock.
+    """
+    import handlers  # noqa: F401  registers the bot handlers
+
+    update = types.Update.de_json(payload)
+    try:
+        bot.process_new_updates([update])
+    except ChatBusy as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=CHAT_BUSY_RETRY_DELAY)
+
+        logger.error(f"Dropped update {update.update_id}: {e}")
+        send_message(e.chat_id, CHAT_BUSY_NOTICE)
+
+
+@celery.task
+def deliver_messages(chat_id):
+    """Send a chat's queued replies."""
+    drain_outbox(chat_id)
+
+
+@celery.task
+def process_audio(
+    remote_path,
+    chat_id,
+    question_number,
+    file_unique_id,
+    file_size=None,
+    duration=None,
+    pending=None,
+):
+    """Transcribe and score a voice answer.
+
+    remote_path is the Telegram file path resolved by the handler, so the
+    task needs no further get_file calls and can run on any worker host.
+    Short voice notes and other small files Whisper can read are handled
+    here, on the IO queue, with no ffmpeg at all. Anything that needs
+    ffmpeg, to transcode it or to split a long recording, is prepared on
+    the transcode queue and then transcribed by transcribe_prepared.
+
+    pending is the token of an answer stored optimistically, which the
+    result replaces instead of being saved as a new answer.
+    """
+    try:
+        # A forwarded or re-sent voice note keeps its file_unique_id, so a hit
+        # here skips the download, ffmpeg and Whisper altogether.
+        transcription = cache_get("transcription_cache", f"uid:{file_unique_id}")
+        cache_record("transcription_cache", transcription is not None)
+        if transcription is not None:
+            finish_audio(
+                remote_path, chat_id, question_number, transcription, pending=pending
+            )
+            return
+
+        upload_format = passthrough_format(remote_path, file_size)
+        if (
+            upload_format is None
+            or duration is None
+            or duration > TRANSCRIPTION_CHUNK_SECONDS
+        ):
+            increment(
+                "audio_files_total",
+                path="transcode" if upload_format is None else "split",
+            )
+            (
+                prepare_audio.s(remote_path, upload_format, duration)
+                | transcribe_prepared.s(
+                    remote_path, chat_id, question_number, file_unique_id, pending
+                )
+            ).delay()
+            return
+
+        increment("audio_files_total", path="passthrough")
+        content_hash = hashlib.sha256()
+        audio = buffer_audio(
+            hash_chunks(stream_telegram_file(remote_path), content_hash)
+        )
+        if not audio:
+            fail_audio(
+                remote_path, chat_id, question_number, "Failed to process audio.", pending
+            )
+            return
+
+        with audio:
+            content_key = f"sha256:{content_hash.hexdigest()}"
+            transcription = cache_get("transcription_cache", content_key)
+            if transcription is None:
+                transcription = transcribe_audio(audio, upload_format)
+
+        finish_audio(
+            remote_path,
+            chat_id,
+            question_number,
+            transcription,
+            [f"uid:{file_unique_id}", content_key],
+            pending,
+        )
+    except Exception as e:
+        print(f"Unexpected error processing {file_unique_id}: {e}")
+        if pending is not None:
+            fail_audio(
+                remote_path, chat_id, question_number, "Failed to process audio.", pending
+            )
+
+
+@celery.task
+def process_pending_audio(
+    file_id, chat_id, question_number, file_unique_id, file_size, duration, pending
+):
+    """Resolve the file path of an optimistically stored voice answer, then
+    process it. The handler skips get_file so the next question goes out
+    after a single Bot API call."""
+    try:
+        with timed("telegram_get_file"):
+            file_info = bot.get_file(file_id)
+    except Exception as e:
+        logger.error(f"Error resolving {file_unique_id}: {e}")
+        fail_audio(None, chat_id, question_number, "Failed to process audio.", pending)
+        return
+
+    process_audio(
+        file_info.file_path,
+        chat_id,
+        question_number,
+        file_unique_id,
+        file_info.file_size or file_size,
+        duration,
+        pending,
+    )
+
+
+@celery.task(acks_late=True, reject_on_worker_lost=True)
+def prepare_audio(remote_path, upload_format, duration):
+    """Download, transcode and split a recording on the transcode queue.
+
+    upload_format is None when the file needs transcoding. The parts are
+    left in Redis for transcribe_prepared, which is chained after this
+    task. Returns the content cache key with either the cached
+    transcription or the parts, or None on failure.
+    """
+    try:
+        content_hash = hashlib.sha256()
+        chunks = hash_chunks(stream_telegram_file(remote_path), content_hash)
+        if upload_format:
+            audio = buffer_audio(chunks)
+        else:
+            audio = compress_audio(chunks, file_extension(remote_path))
+        if not audio:
+            return None
+
+        with audio:
+            content_key = f"sha256:{content_hash.hexdigest()}"
+            transcription = cache_get("transcription_cache", content_key)
+            if transcription is not None:
+                return {"content_key": content_key, "transcription": transcription}
+            data = audio.read()
+
+        audio_format = upload_format or "ogg"
+        parts = split_recording(data, audio_format, duration)
+        if len(parts) > 1:
+            audio_format = "ogg"
+        return {
+            "content_key": content_key,
+            "format": audio_format,
+            "parts": store_audio_parts(parts),
+        }
+    except Exception as e:
+        logger.error(f"Error preparing {remote_path}: {e}")
+        return None
+
+
+@celery.task
+def transcribe_prepared(
+    prepared, remote_path, chat_id, question_number, file_unique_id, pending=None
+):
+    """Transcribe the parts prepare_audio left and record the answer."""
+    try:
+        if prepared is None:
+            fail_audio(
+                remote_path, chat_id, question_number, "Failed to process audio.", pending
+            )
+            return
+
+        transcription = prepared.get("transcription")
+        if transcription is None:
+            parts = load_audio_parts(prepared["parts"])
+            transcription = transcribe_parts(parts, prepared["format"])
+
+        finish_audio(
+            remote_path,
+            chat_id,
+            question_number,
+            transcription,
+            [f"uid:{file_unique_id}", prepared["content_key"]],
+            pending,
+        )
+    except Exception as e:
+        print(f"Unexpected error processing {file_unique_id}: {e}")
+        if pending is not None:
+            fail_audio(
+                remote_path, chat_id, question_number, "Failed to process audio.", pending
+            )
+
+
+def recording_link(remote_path):
+    return f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{remote_path}"
+
+
+def fail_audio(remote_path, chat_id, question_number, text, pending=None):
+    """Tell the candidate a voice answer could not be processed.
+
+    A pending answer is filled in with the recording and no transcript,
+    since the candidate has already moved on, so submit is not held up.
+    """
+    if pending is None:
+        send_message(chat_id, text, reply_markup=get_keyboard(question_number))
+        return
+
+    send_message(
+        chat_id,
+        f"{text} Your answer to question {question_number + 1} was kept without "
+        "a transcript.",
+    )
+    fields = {"transcription_failed": True}
+    if remote_path:
+        fields["remote_path"] = recording_link(remote_path)
+    run_sync(
+        resolve_audio_answer(sync_io, chat_id, question_number, pending, "", **fields)
+    )
+
+
+def finish_audio(
+    remote_path, chat_id, question_number, transcription, cache_keys=(), pending=None
+):
+    """Cache a transcription and record it as the answer, or report failure."""
+    if not transcription:
+        fail_audio(
+            remote_path, chat_id, question_number, "Failed to transcribe audio.", pending
+        )
+        return
+
+    for key in cache_keys:
+        cache_set(
+            "transcription_cache",
+            key,
+            transcription,
+            TRANSCRIPTION_CACHE_TTL,
+            TRANSCRIPTION_CACHE_MAX_ENTRIES,
+        )
+
+    downloadable_link = recording_link(remote_path)
+    if pending is not None:
+        run_sync(
+            resolve_audio_answer(
+                sync_io,
+                chat_id,
+                question_number,
+                pending,
+                transcription,
+                remote_path=downloadable_link,
+            )
+        )
+        return
+
+    run_sync(
+        record_answer(
+            sync_io, chat_id, question_number, transcription, remote_path=downloadable_link
+        )
+    )
+
+
+def store_audio_parts(parts):
+    """Hand audio from the transcode queue to the IO queue through Redis."""
+    keys = [f"audio_part:{uuid.uuid4().hex}" for _ in parts]
+    redis_client = Redis(connection_pool=pool)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key, part in zip(keys, parts):
+            pipe.set(key, part, ex=AUDIO_PART_TTL)
+        pipe.execute()
+    finally:
+        redis_client.close()
+    return keys
+
+
+def load_audio_parts(keys):
+    redis_client = Redis(connection_pool=pool)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        pipe.delete(*keys)
+        parts = pipe.execute()[:-1]
+    finally:
+        redis_client.close()
+    if any(part is None for part in parts):
+        raise RuntimeError("audio parts expired before transcription")
+    return parts
+
+
+# In incremental mode the batched scoring call runs once this question
+# is answered, while the candidate is still on the remaining questions.
+LAST_BATCHED_QUESTION = max([*prompts, roles["location"]])
+
+
+async def record_answer(io, chat_id, question_number, text, **fields):
+    """Score a free-text answer, store it and send the next question.
+
+    fields are stored beside the text, such as the recording's link.
+    Outside per_answer mode the answer is stored unscored for the batched
+    call to fill in. Shared by the handlers and the audio tasks, so io is
+    either runtime's.
+    """
+    answer = await score_answer(io, question_number, {"text": text, **fields})
+
+    next_question = await io.save_answer(chat_id, question_number, answer)
+    if next_question is None:
+        return
+
+    await queue_followups(io, chat_id, question_number, text)
+    await send_question(io, chat_id, next_question)
+
+
+async def resolve_audio_answer(io, chat_id, question_number, pending, text, **fields):
+    """Fill in a voice answer stored as pending, then run the candidate's
+    submit if it was waiting on this answer alone."""
+    answer = await score_answer(io, question_number, {"text": text, **fields})
+
+    submit = await io.blocking(resolve_pending, chat_id, question_number, pending, answer)
+    if submit is None:
+        return
+
+    if text:
+        await queue_followups(io, chat_id, question_number, text)
+    if submit:
+        from handlers import send_email  # handlers imports this module
+
+        await send_email(io, chat_id, wait_for_pending=False)
+
+
+async def score_answer(io, question_number, answer):
+    """Add the rubric score to an answer in per_answer mode."""
+    if SCORING_MODE == "per_answer" and answer["text"]:
+        score = await io.get_score(question_number, answer["text"])
+        if score is not None:
+            answer["score"] = score
+            answer["rubric_version"] = rubric_versions[question_number]
+    return answer
+
+
+async def queue_followups(io, chat_id, question_number, text):
+    """Queue the background work a newly answered question triggers."""
+    if SCORING_MODE == "per_answer":
+        if question_number == roles["location"]:
+            await io.blocking(extract_city.delay, chat_id, text)
+    elif SCORING_MODE == "incremental" and question_number == LAST_BATCHED_QUESTION:
+        await io.blocking(score_answers.delay, chat_id)
+
+
+def hold_submit(chat_id):
+    """Return how many answers a submit is waiting for. If any, the last of
+    them submits, and submit_overdue is queued in case one never finishes."""
+    pending = defer_submit(chat_id)
+    if pending:
+        submit_overdue.apply_async((chat_id,), countdown=PENDING_SUBMIT_TIMEOUT)
+    return pending
+
+
+@celery.task
+def submit_overdue(chat_id):
+    """Submit a deferred report whose pending answers did not all finish."""
+    redis_client = Redis(connection_pool=pool)
+    try:
+        # Whoever clears the flag submits, so this or the last answer does
+        if not redis_client.hdel(chat_id, "submit_requested"):
+            return
+    finally:
+        redis_client.close()
+
+    from handlers import send_email  # handlers imports this module
+
+    run_sync(send_email(sync_io, chat_id, wait_for_pending=False))
+
+
+def score_pending(chat_id):
+    """Score unscored rubric answers and extract a missing city in one call.
+
+    Answers with a cached score skip the batch, and any field the batched
+    completion leaves out or gets wrong goes through get_score or get_city.
+    """
+    redis_client = Redis(connection_pool=pool)
+    try:
+        stored = redis_client.hgetall(chat_id)
+    finally:
+        redis_client.close()
+
+    def stored_answer(question_number):
+        raw = stored.get(f"question_{question_number}".encode("utf-8"))
+        return json.loads(raw) if raw else None
+
+    answers = {}
+    for question_number in prompts:
+        response = stored_answer(question_number)
+        if response and response.get("text") and "score" not in response:
+            answers[question_number] = response["text"]
+
+    location = stored_answer(roles["location"])
+    location = location.get("text") if location and "city" not in location else None
+
+    uncached = {
+        question_number: text
+        for question_number, text in answers.items()
+        if get_cached_score(score_cache_key(question_number, text)) is None
+    }
+    results = batch_score(uncached, location)
+
+    for question_number, text in answers.items():
+        score = results.get(question_number)
+        if score is None:
+            score = get_score(question_number, text)
+        if score is not None:
+            update_answer(
+                chat_id,
+                question_number,
+                text,
+                {"score": score, "rubric_version": rubric_versions[question_number]},
+            )
+
+    if location is not None:
+        if "city" in results:
+            # Stored even when there is no city, so it is not asked again
+            update_answer(
+                chat_id, roles["location"], location, {"city": results["city"] or ""}
+            )
+        else:
+            city = get_city(location)
+            if city:
+                update_answer(chat_id, roles["location"], location, {"city": city})
+
+
+@celery.task
+def score_answers(chat_id):
+    """Run the batched scoring call ahead of submit."""
+    score_pending(chat_id)
+
+
+@celery.task
+def extract_city(chat_id, answer):
+    """Parse the city from the location answer and store it beside the answer."""
+    city = get_city(answer)
+    if not city:
+        return
+
+    update_answer(chat_id, roles["location"], answer, {"city": city})
+
+
+def hash_chunks(chunks, content_hash):
+    """Pass chunks through unchanged while feeding them to content_hash."""
+    for chunk in chunks:
+        content_hash.update(chunk)
+        yield chunk
+
+
+def stream_telegram_file(remote_path):
+    """Yield the contents of a Telegram file in chunks without buffering it."""
+    url = f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{remote_path}"
+    # Covers the whole transfer, which overlaps with the ffmpeg stage
+    with timed("telegram_download"):
+        with telegram_session.get(
+            url, stream=True, timeout=AUDIO_DOWNLOAD_TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            yield from response.iter_content(AUDIO_CHUNK_SIZE)
+
+
+def file_extension(remote_path):
+    return os.path.splitext(remote_path)[1].lstrip(".").lower()
+
+
+def passthrough_format(remote_path, file_size):
+    """The extension to upload a file under as-is, or None if it needs ffmpeg.
+
+    Telegram voice notes are small OGG/Opus files, which Whisper reads
+    directly. Files of unknown size are transcoded to be safe.
+    """
+    extension = file_extension(remote_path)
+    if extension not in WHISPER_FORMATS:
+        return None
+    if file_size is None or file_size > AUDIO_PASSTHROUGH_MAX_SIZE:
+        return None
+    return extension
+
+
+def buffer_audio(chunks):
+    """Collect an audio stream into a spooled file without transcoding it.
+
+    Returns the file positioned at the start, or None on failure.
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_MAX_SIZE)
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+        if output.tell() == 0:
+            raise RuntimeError("empty download")
+        output.seek(0)
+        return output
+    except Exception as e:
+        logger.error(f"Error downloading audio: {e}")
+        output.close()
+        return None
+
+
+@contextlib.contextmanager
+def ffmpeg_input(chunks, audio_format):
+    """Yield an ffmpeg input for an audio stream, and the chunks to pipe
+    into its stdin.
+
+    Formats in SEEKABLE_FORMATS are spooled to a temp file that ffmpeg
+    reads instead, and there is nothing left to pipe (None).
+    """
+    import ffmpeg
+
+    if audio_format not in SEEKABLE_FORMATS:
+        yield ffmpeg.input("pipe:0"), chunks
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=f".{audio_format}") as spool:
+        for chunk in chunks:
+            spool.write(chunk)
+        spool.flush()
+        yield ffmpeg.input(spool.name), None
+
+
+def compress_audio(chunks, audio_format=None):
+    """Transcode an audio stream to 16 kHz mono Opus using ffmpeg.
+
+    The input chunks are piped into ffmpeg's stdin, or spooled to a temp
+    file first for formats ffmpeg has to seek in. Its stdout is collected
+    into a spooled file, which stays in memory up to AUDIO_SPOOL_MAX_SIZE
+    bytes and rolls over to a temp file beyond that. Returns the spooled
+    file positioned at the start, or None on failure.
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_MAX_SIZE)
+    feed_errors = []
+
+    try:
+        with timed("transcode"), ffmpeg_input(chunks, audio_format) as (source, piped):
+            process = (
+                source
+                .output(
+                    "pipe:1",
+                    format="ogg",
+                    ac=1,
+                    ar=16000,
+                    codec="libopus",
+                    audio_bitrate="16k",
+                    application="voip",
+                )
+                .global_args("-nostdin", "-loglevel", "error")
+                .run_async(pipe_stdin=piped is not None, pipe_stdout=True)
+            )
+
+            def feed():
+                try:
+                    for chunk in piped:
+                        process.stdin.write(chunk)
+                except Exception as e:
+                    feed_errors.append(e)
+                finally:
+                    try:
+                        process.stdin.close()
+                    except OSError:
+                        pass
+
+            writer = None
+            if piped is not None:
+                writer = threading.Thread(target=feed, daemon=True)
+                writer.start()
+            for chunk in iter(lambda: process.stdout.read(AUDIO_CHUNK_SIZE), b""):
+                output.write(chunk)
+            if writer is not None:
+                writer.join()
+            process.wait()
+
+            if feed_errors:
+                raise feed_errors[0]
+            if process.returncode != 0 or output.tell() == 0:
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+
+            output.seek(0)
+            return output
+    except Exception as e:
+        logger.error(f"Error compressing audio: {e}")
+        output.close()
+        return None
+
+
+def find_silences(data, audio_format=None):
+    """Return the midpoints of the pauses in a recording and its length."""
+    with ffmpeg_input([data], audio_format) as (source, piped):
+        _, log = (
+            source.audio.filter(
+                "silencedetect", noise=SILENCE_NOISE, d=SILENCE_MIN_DURATION
+            )
+            .output("-", format="null")
+            .global_args("-nostdin")
+            .run(
+                input=data if piped is not None else None,
+                capture_stdout=True,
+                capture_stderr=True,
+            )
+        )
+    log = log.decode(errors="replace")
+
+    silences = []
+    start = None
+    for kind, seconds in SILENCE_PATTERN.findall(log):
+        if kind == "start":
+            start = float(seconds)
+        elif start is not None:
+            silences.append((max(start, 0) + float(seconds)) / 2)
+            start = None
+
+    progress = PROGRESS_PATTERN.findall(log)
+    if progress:
+        hours, minutes, seconds = progress[-1]
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    else:
+        duration = None
+    return silences, duration
+
+
+def plan_chunks(silences, duration, chunk_seconds):
+    """Pick cut points so no chunk is longer than chunk_seconds.
+
+    Each chunk ends at the last pause in the second half of its window,
+    or at the window's end when the speaker never pauses there.
+    """
+    cuts = []
+    start = 0.0
+    while duration - start > chunk_seconds:
+        end = start + chunk_seconds
+        pauses = [t for t in silences if start + chunk_seconds / 2 <= t <= end]
+        start = pauses[-1] if pauses else end
+        cuts.append(start)
+    return cuts
+
+
+def split_audio(data, cuts, upload_format):
+    """Cut a recording at the given times into Ogg/Opus chunks.
+
+    Voice notes and transcoded uploads are Opus already, so their packets
+    are copied as they are; other formats are encoded to 16 kHz Opus.
+    """
+    if upload_format in ("ogg", "oga"):
+        encoding = {"codec": "copy"}
+    else:
+        encoding = {
+            "ac": 1,
+            "ar": 16000,
+            "codec": "libopus",
+            "audio_bitrate": "16k",
+            "application": "voip",
+        }
+
+    with tempfile.TemporaryDirectory() as directory, ffmpeg_input(
+        [data], upload_format
+    ) as (source, piped):
+        (
+            source
+            .output(
+                os.path.join(directory, "chunk%04d.ogg"),
+                format="segment",
+                segment_format="ogg",
+                segment_times=",".join(f"{cut:.3f}" for cut in cuts),
+                reset_timestamps=1,
+                # Fixed Ogg serial numbers, so identical audio yields
+                # identical chunks and hits the per-chunk cache
+                fflags="+bitexact",
+                **encoding,
+            )
+            .global_args("-nostdin", "-loglevel", "error")
+            .run(input=data if piped is not None else None, capture_stderr=True)
+        )
+        chunks = []
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "rb") as f:
+                chunks.append(f.read())
+        return chunks
+
+
+def transcribe_chunk(data):
+    """Transcribe one chunk of a long recording, cached by its content."""
+    key = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    transcription = cache_get("transcription_cache", key)
+    if transcription is None:
+        with io.BytesIO(data) as chunk:
+            transcription = transcribe_audio(chunk, "ogg")
+        if transcription is not None:
+            cache_set(
+                "transcription_cache",
+                key,
+                transcription,
+                TRANSCRIPTION_CACHE_TTL,
+                TRANSCRIPTION_CACHE_MAX_ENTRIES,
+            )
+    return transcription
+
+
+def split_recording(data, upload_format, duration=None):
+    """Split a long recording at pauses, or return it whole.
+
+    Recordings no longer than TRANSCRIPTION_CHUNK_SECONDS, and any that
+    fail to split, come back as a single part.
+    """
+    if duration is not None and duration <= TRANSCRIPTION_CHUNK_SECONDS:
+        return [data]
+
+    try:
+        with timed("split_audio"):
+            silences, measured = find_silences(data, upload_format)
+            cuts = plan_chunks(
+                silences, measured or duration or 0, TRANSCRIPTION_CHUNK_SECONDS
+            )
+            if cuts:
+                return split_audio(data, cuts, upload_format) or [data]
+    except Exception as e:
+        logger.error(f"Error splitting audio: {e}")
+    return [data]
+
+
+def transcribe_parts(parts, upload_format):
+    """Transcribe the parts of a recording concurrently and join them in order.
+
+    A long answer takes about as long as its slowest part and never
+    approaches the upload size limit. Each part of a split recording is
+    cached on its own, so a retry only pays for the parts that failed.
+    """
+    if len(parts) == 1:
+        with io.BytesIO(parts[0]) as audio:
+            return transcribe_audio(audio, upload_format)
+
+    workers = min(TRANSCRIPTION_CHUNK_CONCURRENCY, len(parts))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        texts = list(executor.map(transcribe_chunk, parts))
+    if any(text is None for text in texts):
+        return None
+    return " ".join(text.strip() for text in texts if text.strip())
+
+
+def transcribe_audio(audio_file, upload_format="ogg"):
+    """Transcribe an audio file object using OpenAI's Whisper model.
+
+    upload_format is the file extension Whisper uses to pick a decoder.
+    """
+    try:
+        client = get_openai_client()
+
+        def request():
+            # Rewind so a retried upload sends the whole file again
+            audio_file.seek(0)
+            return client.audio.transcriptions.create(
+                model="whisper-1", file=(f"audio.{upload_format}", audio_file), language="en"
+            )
+
+        with timed("whisper"):
+            transcription = call_openai("whisper", request)
+
+        return transcription.text
+    except Exception as e:
+        logger.error(f"Error transcribing audio: {e}")
+        return None